@@ -0,0 +1,67 @@
+"""Synthetic documents and BioC collections for the benchmarks."""
+import random
+import string
+
+from xml.sax.saxutils import escape, quoteattr
+
+
+def generate_words(count, rng):
+    return [''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 10))) for _ in range(count)]
+
+
+def generate_document(denotation_count, entity_type_ids, relation_type_ids, relation_density=0.5, seed=0,
+                      text_seed=0):
+    """
+    Generates a document in the format accepted by save_document: every denotation covers one word,
+    and roughly relation_density relations per denotation connect neighbouring denotations.
+    Documents with the same text_seed share their text, so they can be used as annotations of different users.
+    """
+    words = generate_words(denotation_count * 2, random.Random(text_seed))
+    rng = random.Random(seed)
+    denotations = []
+    offset = 0
+    for index, word in enumerate(words):
+        if index % 2 == 0:
+            denotations.append({'id': 'T%d' % len(denotations),
+                                'span': {'begin': offset, 'end': offset + len(word)},
+                                'obj': {'id': rng.choice(entity_type_ids)}})
+        offset += len(word) + 1
+    relations = []
+    for index in range(int(denotation_count * relation_density)):
+        subj = rng.randrange(denotation_count)
+        obj = min(denotation_count - 1, subj + rng.randint(1, 5))
+        relations.append({'id': 'R%d' % index,
+                          'subj': 'T%d' % subj,
+                          'obj': 'T%d' % obj,
+                          'pred': {'id': rng.choice(relation_type_ids)}})
+    return {'text': ' '.join(words), 'denotations': denotations, 'relations': relations}
+
+
+def generate_bioc_collection(document_count, annotations_per_document, entity_codes, relation_codes,
+                             relation_density=0.5, seed=0):
+    rng = random.Random(seed)
+    parts = ["<?xml version='1.0' encoding='UTF-8'?><!DOCTYPE collection SYSTEM 'BioC.dtd'>",
+             '<collection><source>benchmark</source><date></date><key></key>']
+    for document_index in range(document_count):
+        words = generate_words(annotations_per_document * 2, rng)
+        text = ' '.join(words)
+        parts.append('<document><id>doc%d</id><passage><infon key="type">abstract</infon><offset>0</offset>'
+                     '<text>%s</text>' % (document_index, escape(text)))
+        offset = 0
+        annotation_count = 0
+        for index, word in enumerate(words):
+            if index % 2 == 0:
+                parts.append('<annotation id="T%d"><infon key="type">%s</infon>'
+                             '<location offset="%d" length="%d"/><text>%s</text></annotation>'
+                             % (annotation_count, escape(rng.choice(entity_codes)), offset, len(word), word))
+                annotation_count += 1
+            offset += len(word) + 1
+        for index in range(int(annotation_count * relation_density)):
+            subj = rng.randrange(annotation_count)
+            obj = min(annotation_count - 1, subj + rng.randint(1, 5))
+            parts.append('<relation id="R%d"><infon key="type">%s</infon>'
+                         '<node refid=%s role=""/><node refid=%s role=""/></relation>'
+                         % (index, escape(rng.choice(relation_codes)), quoteattr('T%d' % subj), quoteattr('T%d' % obj)))
+        parts.append('</passage></document>')
+    parts.append('</collection>')
+    return ''.join(parts)
@@ -0,0 +1,216 @@
+"""
+End-to-end benchmarks of the document, import, export and evaluation paths against the local database.
+
+Usage: python benchmarks/run.py [--sizes 1000,10000] [--repeat 5] [--users 3] [--latency 0.0005]
+                                [--output results.json] [--compare baseline.json]
+"""
+import argparse
+import gc
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from corpus import generate_document, generate_bioc_collection
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark the middleware against the local database.')
+    parser.add_argument('--sizes', default='1000,10000', help='comma separated denotation counts per document')
+    parser.add_argument('--repeat', type=int, default=5, help='measured runs per scenario')
+    parser.add_argument('--users', type=int, default=3, help='number of users annotating every document')
+    parser.add_argument('--bioc-documents', type=int, default=10, help='documents per imported BioC collection')
+    parser.add_argument('--latency', type=float, default=0.0, help='artificial latency per round trip in seconds')
+    parser.add_argument('--output', default=None, help='file to store the results as JSON')
+    parser.add_argument('--compare', default=None, help='earlier results to compare against')
+    return parser.parse_args()
+
+
+def configure_local_database(latency):
+    directory = tempfile.mkdtemp(prefix='ltn_benchmark_')
+    settings_path = os.path.join(directory, 'settings.json')
+    with open(settings_path, 'w') as f:
+        json.dump({'database': {'backend': 'sqlite', 'path': os.path.join(directory, 'ltn.sqlite'),
+                                'latency': latency},
+                   'secrets': {'development_key': 'benchmark'}}, f)
+    os.environ['LTN_SETTINGS'] = settings_path
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def get_rss_kb():
+    """Current resident set size of the process, or None where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / 1024
+    except (IOError, IndexError, ValueError):
+        return None
+
+
+def measure(name, function, repeat):
+    from ltnserver import localdb
+    latencies = []
+    round_trips = []
+    gc.collect()
+    rss_before = get_rss_kb()
+    for _ in range(repeat):
+        localdb.reset_round_trips()
+        start = time.time()
+        function()
+        latencies.append(1000 * (time.time() - start))
+        round_trips.append(localdb.get_round_trips())
+    result = {'name': name,
+              'runs': repeat,
+              'mean_ms': sum(latencies) / len(latencies),
+              'p50_ms': percentile(latencies, 0.5),
+              'p90_ms': percentile(latencies, 0.9),
+              'p99_ms': percentile(latencies, 0.99),
+              'max_ms': max(latencies),
+              'round_trips': max(round_trips),
+              # memory the scenario kept, e.g. in caches, independent of the scenarios measured before
+              'rss_delta_kb': None}
+    gc.collect()
+    rss_after = get_rss_kb()
+    if rss_before is not None and rss_after is not None:
+        result['rss_delta_kb'] = rss_after - rss_before
+    print '%-40s p50 %9.1f ms  p90 %9.1f ms  %6d round trips  %8s KB retained' % \
+        (name, result['p50_ms'], result['p90_ms'], result['round_trips'],
+         'n/a' if result['rss_delta_kb'] is None else '%+d' % result['rss_delta_kb'])
+    return result
+
+
+def seed_database(user_count):
+    from ltnserver import get_connection, release_connection
+    connection = get_connection()
+    cursor = connection.cursor()
+    for index in range(user_count):
+        cursor.execute('INSERT INTO LTN_DEVELOP.USERS VALUES (?, ?, ?, ?, NULL)',
+                       ('bench%d' % index, 'Benchmark %d' % index, 'benchmark', ''))
+    cursor.execute("INSERT INTO LTN_DEVELOP.TASKS (NAME, DOMAIN, CONFIG, AUTHOR) "
+                   "VALUES ('Benchmark', 'BENCHMARK', '', 'bench0')")
+    task_id = cursor.cursor.lastrowid
+    entity_codes = ['T%03d' % index for index in range(10)]
+    relation_codes = ['R%03d' % index for index in range(3)]
+    entity_type_ids, relation_type_ids = [], []
+    for codes, type_ids, relation in [(entity_codes, entity_type_ids, 0), (relation_codes, relation_type_ids, 1)]:
+        for code in codes:
+            cursor.execute('INSERT INTO LTN_DEVELOP.TYPES (CODE, NAME, GROUP_ID, "GROUP") VALUES (?, ?, ?, ?)',
+                           (code, 'Type ' + code, 'G' + code[0], 'Group ' + code[0]))
+            cursor.execute('INSERT INTO LTN_DEVELOP.TASK_TYPES (LABEL, TASK_ID, TYPE_ID, RELATION) '
+                           'VALUES (?, ?, ?, ?)', (code.lower(), task_id, cursor.cursor.lastrowid, relation))
+            type_ids.append(cursor.cursor.lastrowid)
+    connection.commit()
+    cursor.close()
+    release_connection()
+    return task_id, entity_codes, relation_codes, entity_type_ids, relation_type_ids
+
+
+def logged_in_client(app, user_id):
+    client = app.test_client()
+    response = client.post('/login', data=json.dumps({'username': user_id, 'password': 'benchmark'}),
+                           content_type='application/json')
+    assert response.status_code == 200, response.data
+    return client
+
+
+def post_json(client, url, data, expected_status=200):
+    response = client.post(url, data=json.dumps(data), content_type='application/json')
+    assert response.status_code == expected_status, '%s: %s %s' % (url, response.status_code, response.data)
+    return response
+
+
+def get(client, url):
+    response = client.get(url)
+    assert response.status_code == 200, '%s: %s %s' % (url, response.status_code, response.data)
+    return response
+
+
+def run_benchmarks(arguments):
+    from ltnserver import app
+    from ltnserver.formats import extract_documents_from_bioc
+    from ltnserver.documents import load_document
+
+    task_id, entity_codes, relation_codes, entity_type_ids, relation_type_ids = seed_database(arguments.users)
+    clients = [logged_in_client(app, 'bench%d' % index) for index in range(arguments.users)]
+    results = []
+    for size in [int(size) for size in arguments.sizes.split(',')]:
+        document_id = 'benchmark_%d' % size
+        documents = [generate_document(size, entity_type_ids, relation_type_ids, seed=index)
+                     for index in range(arguments.users)]
+        post_json(clients[0], '/import', {'type': 'plaintext', 'task': task_id, 'document_id': document_id,
+                                          'text': documents[0]['text']}, 201)
+        for client, document in zip(clients, documents):
+            document['task_id'] = task_id
+            post_json(client, '/documents/' + document_id, document)
+
+        results.append(measure('save_document[%d]' % size,
+                               lambda: post_json(clients[0], '/documents/' + document_id, documents[0]),
+                               arguments.repeat))
+
+        def load_directly():
+            with app.test_request_context():
+                load_document(document_id, 'bench0')
+        results.append(measure('load_document[%d]' % size, load_directly, arguments.repeat))
+        results.append(measure('GET /documents[%d]' % size,
+                               lambda: get(clients[0], '/documents/' + document_id), arguments.repeat))
+        results.append(measure('GET /export[%d]' % size,
+                               lambda: get(clients[0], '/export/' + document_id), arguments.repeat))
+        if arguments.users > 1:
+            results.append(measure('POST /evaluate[%d]' % size,
+                                   lambda: post_json(clients[0], '/evaluate', {'document_id': document_id,
+                                                                               'user1': 'bench0',
+                                                                               'user2': 'bench1'}),
+                                   arguments.repeat))
+
+        per_document = max(1, size / arguments.bioc_documents)
+        collection = generate_bioc_collection(arguments.bioc_documents, per_document, entity_codes, relation_codes)
+        results.append(measure('extract_documents_from_bioc[%d]' % size,
+                               lambda: extract_documents_from_bioc(collection, 'extract', task_id),
+                               arguments.repeat))
+        imports = iter(range(arguments.repeat))
+        results.append(measure('POST /import bioc[%d]' % size,
+                               lambda: post_json(clients[0], '/import',
+                                                 {'type': 'bioc', 'task': task_id, 'text': collection,
+                                                  'document_id': 'import_%d_%d' % (size, next(imports))}, 201),
+                               arguments.repeat))
+    return results
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = dict((result['name'], result) for result in json.load(f)['results'])
+    print
+    print 'Comparison with %s (p50 ratio, round trips):' % baseline_path
+    for result in results:
+        previous = baseline.get(result['name'])
+        if previous is None:
+            continue
+        ratio = result['p50_ms'] / previous['p50_ms'] if previous['p50_ms'] else 0.0
+        print '%-40s %6.2fx  %6d -> %6d' % (result['name'], ratio, previous['round_trips'], result['round_trips'])
+
+
+def main():
+    arguments = parse_arguments()
+    configure_local_database(arguments.latency)
+    # ltnserver reads the static folder from the command line
+    sys.argv = sys.argv[:1]
+    sys.path.insert(0, ROOT)
+    results = run_benchmarks(arguments)
+    if arguments.output:
+        with open(arguments.output, 'w') as f:
+            json.dump({'created_at': time.strftime('%Y-%m-%d %H:%M:%S'), 'arguments': vars(arguments),
+                       'results': results}, f, indent=2)
+    if arguments.compare:
+        compare(results, arguments.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,19 @@
 import sys
+import time
 import pyhdb
-import json
 
+from contextlib import contextmanager
 from signal import signal, SIGINT
-from flask import Flask, Response, redirect, url_for
+from multiprocessing.pool import ThreadPool
+from threading import Lock, local
+from flask import Flask, Response, redirect, url_for, request, g
 from flask.ext.cors import CORS
 
 from settings import get_settings, get_root_path
+from pool import ConnectionPool
+from cache import get_cache_stats
+from responses import timed_encode, compress_response, response_stats
+import localdb
 
 static_folder = "static"
 if len(sys.argv) >= 2:
@@ -20,10 +27,16 @@ app.config.from_object(__name__)
 
 context = (get_root_path('certificate.crt'), get_root_path('certificate.key'))
 
-connection = None
+pool = None
+pool_lock = Lock()
+checked_out = local()
+query_workers = None
+compression_settings = get_settings('compression') or {}
 
 
 def init():
+    # before any connection is opened
+    imports.init_parse_workers()
     try_reconnecting()
 
 
@@ -32,30 +45,170 @@ def init_training():
     training.init()
 
 
-def reset_connection():
-    global connection
-    if connection is not None:
-        try:
-            connection.close()
-        except Exception, e:
-            print e
-    connection = None
+def connect():
+    db = get_settings('database')
+    if db.get('backend') == 'sqlite':
+        return localdb.connect(db)
+    return pyhdb.connect(
+        host=db['host'],
+        port=db['port'],
+        user=db['username'],
+        password=db['password']
+    )
+
+
+def get_pool():
+    global pool
+    with pool_lock:
+        if pool is None:
+            db = get_settings('database')
+            pool = ConnectionPool(connect,
+                                  min_size=db.get('pool_min_size', 1),
+                                  max_size=db.get('pool_max_size', 10),
+                                  timeout=db.get('pool_timeout', 30),
+                                  ping_after=db.get('pool_ping_after', 60))
+    return pool
 
 
 def get_connection():
+    """Returns the connection checked out by the current thread, checking one out from the pool if necessary."""
+    connection = getattr(checked_out, 'connection', None)
+    if connection is None:
+        connection = get_pool().checkout()
+        checked_out.connection = connection
     return connection
 
 
+def release_connection():
+    connection = getattr(checked_out, 'connection', None)
+    if connection is not None:
+        checked_out.connection = None
+        get_pool().checkin(connection)
+
+
+@contextmanager
+def pooled_connection():
+    try:
+        yield get_connection()
+    finally:
+        release_connection()
+
+
+@contextmanager
+def transaction():
+    """
+    Unit of work on the current connection: commits once when the outermost transaction ends
+    and rolls back on errors. Nested transactions join the outer one.
+    """
+    connection = get_connection()
+    connection.transaction_depth += 1
+    try:
+        yield connection
+        if connection.transaction_depth == 1:
+            connection.commit()
+    except Exception:
+        if connection.transaction_depth == 1:
+            try:
+                connection.rollback()
+            except Exception, e:
+                print e
+                connection.broken = True
+        raise
+    finally:
+        connection.transaction_depth -= 1
+
+
+def execute_prepared(cursor, sql, params):
+    """Executes a (procedure) statement, preparing it only once per pooled connection."""
+    # the cursor may come from a borrowed connection, its statements are not valid on any other one
+    connection = get_pool().owner(cursor)
+    if connection is None:
+        cursor.execute_prepared(cursor.get_prepared_statement(cursor.prepare(sql)), [params])
+        return
+    statement = connection.prepared_statement(cursor, sql)
+    try:
+        cursor.execute_prepared(statement, [params])
+    except pyhdb.Warning:
+        # e.g. the rows affected warning of procedures, the statement is still valid
+        raise
+    except Exception:
+        connection.statements.pop(sql, None)
+        raise
+
+
+def get_query_workers():
+    global query_workers
+    with pool_lock:
+        if query_workers is None:
+            query_workers = ThreadPool(get_settings('database').get('query_workers', 4))
+    return query_workers
+
+
+def run_query(connection, query):
+    start = time.time()
+    cursor = connection.cursor()
+    try:
+        return query(cursor), 1000 * (time.time() - start)
+    finally:
+        cursor.close()
+
+
+def run_borrowed_query(arguments):
+    connection, query = arguments
+    # queries calling get_connection() have to use the borrowed connection instead of checking out their own
+    checked_out.connection = connection
+    try:
+        return run_query(connection, query)
+    finally:
+        checked_out.connection = None
+
+
+def run_queries(queries, timings=None):
+    """
+    Runs independent queries, given as name -> function(cursor), concurrently on the connection of the current
+    thread and on idle pooled connections. Connections are only borrowed if the pool has them available
+    without waiting, otherwise the remaining queries run one after another on the current connection.
+    Inside a transaction they all run on its connection, so they see its uncommitted changes.
+    Returns the results by name and adds the time each query took in milliseconds to timings.
+    """
+    names = list(queries)
+    connection = get_connection()
+    borrowed = []
+    if connection.transaction_depth == 0:
+        for _ in range(min(len(names) - 1, get_settings('database').get('query_workers', 4))):
+            extra_connection = get_pool().checkout(blocking=False)
+            if extra_connection is None:
+                break
+            borrowed.append(extra_connection)
+    concurrent = None
+    try:
+        if borrowed:
+            concurrent = get_query_workers().map_async(run_borrowed_query,
+                                                       zip(borrowed, [queries[name] for name in names]))
+        results = [run_query(connection, queries[name]) for name in names[len(borrowed):]]
+        if concurrent is not None:
+            results = concurrent.get() + results
+    finally:
+        if concurrent is not None:
+            concurrent.wait()
+        for extra_connection in borrowed:
+            get_pool().checkin(extra_connection)
+    if timings is not None:
+        timings.update((name, duration) for name, (_, duration) in zip(names, results))
+    return dict((name, result) for name, (result, _) in zip(names, results))
+
+
+def reset_connection():
+    # only the connection of the failing thread is replaced, other requests keep theirs
+    connection = getattr(checked_out, 'connection', None)
+    if connection is not None:
+        connection.broken = True
+        release_connection()
+
+
 def try_reconnecting():
     try:
-        global connection
-        db = get_settings('database')
-        connection = pyhdb.connect(
-            host=db['host'],
-            port=db['port'],
-            user=db['username'],
-            password=db['password']
-        )
+        get_pool().fill()
     except Exception, e:
         print e
 
@@ -64,12 +217,48 @@ def handle_signal(s, _):
     print 'Gracefully shutting down. Please wait...'
     training.should_continue = False
     training.model_thread.join()
+    get_pool().close()
     print 'Done. Goodbye.'
     sys.exit(0)
 
 
 def respond_with(response):
-    return Response(json.dumps(response), mimetype='application/json')
+    data, g.encode_time = timed_encode(response)
+    return Response(data, mimetype='application/json')
+
+
+@app.after_request
+def compress(response):
+    raw_size = response.content_length
+    try:
+        compress_response(response, request.accept_encodings, compression_settings.get('min_size', 1024),
+                          compression_settings.get('level', 6))
+    except Exception, e:
+        print 'Could not compress response: ', e
+    if request.url_rule is not None and not response.is_streamed:
+        response_stats.record(request.url_rule.rule, g.get('encode_time'), raw_size or 0,
+                              response.content_length or 0)
+    return response
+
+
+@app.teardown_request
+def release_request_connection(exception):
+    release_connection()
+
+
+@app.route('/stats/responses')
+def get_response_stats():
+    return respond_with(response_stats.stats())
+
+
+@app.route('/stats/pool')
+def get_pool_stats():
+    return respond_with(get_pool().stats())
+
+
+@app.route('/stats/caches')
+def get_caches_stats():
+    return respond_with(get_cache_stats())
 
 
 @app.route('/')
@@ -82,5 +271,9 @@ import types
 import tasks
 import documents
 import formats
+import imports
+import pubmed
 import training
+import tagger
 import prediction
+import evaluation
@@ -0,0 +1,208 @@
+import StringIO
+import zipfile
+
+import bioc
+from xml.etree import cElementTree
+from xml.sax.saxutils import XMLGenerator
+
+HEADER = "<?xml version='1.0' encoding='UTF-8'?>\n<!DOCTYPE collection SYSTEM 'BioC.dtd'>\n"
+
+
+class BioCWriter:
+    """
+    Writes a BioC collection document by document. The XML written so far is taken out with flush(),
+    so only the current document has to be kept in memory.
+    """
+
+    def __init__(self):
+        self.buffer = StringIO.StringIO()
+        self.xml = XMLGenerator(self.buffer, 'utf-8')
+
+    def start_collection(self, source='', date='', key='', infons=None):
+        self.buffer.write(HEADER)
+        self.xml.startElement('collection', {})
+        self.text_element('source', source)
+        self.text_element('date', date)
+        self.text_element('key', key)
+        self.write_infons(infons or {})
+
+    def end_collection(self):
+        self.xml.endElement('collection')
+        self.buffer.write('\n')
+
+    def write_document(self, document):
+        self.xml.startElement('document', {})
+        self.text_element('id', document.id)
+        self.write_infons(document.infons)
+        for passage in document.passages:
+            self.write_passage(passage)
+        for relation in getattr(document, 'relations', []):
+            self.write_relation(relation)
+        self.xml.endElement('document')
+        self.buffer.write('\n')
+
+    def write_passage(self, passage):
+        self.xml.startElement('passage', {})
+        self.write_infons(passage.infons)
+        self.text_element('offset', passage.offset)
+        if passage.text:
+            self.text_element('text', passage.text)
+        for annotation in passage.annotations:
+            self.write_annotation(annotation)
+        for relation in passage.relations:
+            self.write_relation(relation)
+        self.xml.endElement('passage')
+
+    def write_annotation(self, annotation):
+        self.xml.startElement('annotation', {'id': to_text(annotation.id)})
+        self.write_infons(annotation.infons)
+        for location in annotation.locations:
+            self.xml.startElement('location', {'offset': to_text(location.offset),
+                                               'length': to_text(location.length)})
+            self.xml.endElement('location')
+        self.text_element('text', annotation.text)
+        self.xml.endElement('annotation')
+
+    def write_relation(self, relation):
+        self.xml.startElement('relation', {'id': to_text(relation.id)})
+        self.write_infons(relation.infons)
+        for node in relation.nodes:
+            self.xml.startElement('node', {'refid': to_text(node.refid), 'role': to_text(node.role)})
+            self.xml.endElement('node')
+        self.xml.endElement('relation')
+
+    def write_infons(self, infons):
+        for key, value in sorted(infons.items()):
+            self.xml.startElement('infon', {'key': to_text(key)})
+            self.xml.characters(to_text(value))
+            self.xml.endElement('infon')
+
+    def text_element(self, name, value):
+        self.xml.startElement(name, {})
+        self.xml.characters(to_text(value))
+        self.xml.endElement(name)
+
+    def flush(self):
+        data = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return data
+
+
+def to_text(value):
+    if value is None:
+        return u''
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return unicode(value)
+
+
+def collection_chunks(documents):
+    """Generates a BioC collection of the given BioC documents, one chunk of XML per document."""
+    writer = BioCWriter()
+    writer.start_collection()
+    yield writer.flush()
+    for document in documents:
+        writer.write_document(document)
+        yield writer.flush()
+    writer.end_collection()
+    yield writer.flush()
+
+
+class ZipStream:
+    """Write-only file object for zipfile that hands out the bytes written so far, so zips can be streamed."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = ''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def zip_chunks(files):
+    """Generates a zip archive of (name, chunks) pairs, one chunk of the archive per file."""
+    stream = ZipStream()
+    archive = zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED)
+    for name, chunks in files:
+        archive.writestr(name, ''.join(chunks))
+        yield stream.drain()
+    archive.close()
+    yield stream.drain()
+
+
+def iterate_documents(stream):
+    """
+    Parses a BioC collection from a file-like object one document at a time. Every document is
+    converted to the objects of the bioc library and dropped from the parse tree before the next is read.
+    """
+    for element in iterate_document_elements(stream):
+        yield read_document(element)
+
+
+def iterate_document_elements(stream):
+    root = None
+    for event, element in cElementTree.iterparse(stream, events=('start', 'end')):
+        if root is None:
+            root = element
+        if event == 'end' and element.tag == 'document':
+            yield element
+            root.clear()
+
+
+def read_document_xml(xml):
+    return read_document(cElementTree.fromstring(xml))
+
+
+def read_document(element):
+    document = bioc.BioCDocument()
+    document.id = element.findtext('id', '')
+    document.infons = read_infons(element)
+    for passage_element in element.findall('passage'):
+        passage = bioc.BioCPassage()
+        read_annotated(passage, passage_element)
+        for sentence_element in passage_element.findall('sentence'):
+            sentence = bioc.BioCSentence()
+            read_annotated(sentence, sentence_element)
+            passage.add_sentence(sentence)
+        document.add_passage(passage)
+    return document
+
+
+def read_annotated(target, element):
+    """Reads what passages and sentences have in common."""
+    target.infons = read_infons(element)
+    target.offset = int(element.findtext('offset', '0'))
+    target.text = element.findtext('text', '')
+    for annotation_element in element.findall('annotation'):
+        annotation = bioc.BioCAnnotation()
+        annotation.id = annotation_element.get('id')
+        annotation.infons = read_infons(annotation_element)
+        annotation.text = annotation_element.findtext('text', '')
+        for location_element in annotation_element.findall('location'):
+            annotation.locations.append(bioc.BioCLocation(int(location_element.get('offset')),
+                                                          int(location_element.get('length'))))
+        target.add_annotation(annotation)
+    for relation_element in element.findall('relation'):
+        relation = bioc.BioCRelation()
+        relation.id = relation_element.get('id')
+        relation.infons = read_infons(relation_element)
+        for node_element in relation_element.findall('node'):
+            relation.add_node(bioc.BioCNode(node_element.get('refid'), node_element.get('role', '')))
+        target.add_relation(relation)
+
+
+def read_infons(element):
+    return dict((infon.get('key'), infon.text or '') for infon in element.findall('infon'))
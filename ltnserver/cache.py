@@ -0,0 +1,70 @@
+import sys
+
+from collections import OrderedDict
+from threading import Lock
+
+
+caches = {}
+
+
+class LRUCache:
+    """Thread-safe least recently used cache, bounded by the summed size of its values."""
+
+    def __init__(self, name, max_size, size_of=sys.getsizeof):
+        self.name = name
+        self.max_size = max_size
+        self.size_of = size_of
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        caches[name] = self
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            value, size = self.entries.pop(key)
+            self.entries[key] = (value, size)
+            return value
+
+    def put(self, key, value):
+        size = self.size_of(value)
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            if size > self.max_size:
+                return
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries),
+                    'size': self.size,
+                    'max_size': self.max_size,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+def get_cache_stats():
+    return dict((name, cache.stats()) for name, cache in caches.iteritems())
@@ -1,18 +1,35 @@
-from flask import request
+import hashlib
+import json
+
+from flask import request, Response, stream_with_context
 from flask_login import current_user
 
+from collections import Counter, OrderedDict
 from datetime import datetime
 
-from ltnserver import app, try_reconnecting, reset_connection, get_connection, respond_with
+from ltnserver import app, reset_connection, get_connection, respond_with, execute_prepared, transaction, \
+    run_queries
+from ltnserver.cache import LRUCache
+from ltnserver.settings import get_settings
 from ltnserver.training import model_training_queue
-from ltnserver.types import get_entity_types, get_relation_types
+from ltnserver.types import get_entity_types, get_relation_types, get_types_of_task, document_tasks, \
+    get_document_task, get_type_catalogue
+
+MAX_BATCH_SIZE = 1000
+
+# document texts never change after the import, so they are only invalidated on deletion
+document_texts = LRUCache('document_texts',
+                          (get_settings('cache') or {}).get('document_text_bytes', 64 * 1024 * 1024))
 
 
 @app.route('/user_documents_for/<document_id>')
 def get_document_details(document_id):
     user_documents = list()
-    cursor = get_connection().cursor()
     user_id = current_user.get_id()
+    etag = get_document_etag('details', document_id, user_id)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    cursor = get_connection().cursor()
     cursor.execute(
         'SELECT d.id, MIN(d.user_id), MIN(u.name), COUNT(DISTINCT e.id), COUNT(distinct p.id), MIN(d.visibility) '
         'FROM LTN_DEVELOP.USER_DOCUMENTS d '
@@ -25,19 +42,43 @@ def get_document_details(document_id):
         user_documents.append({'id': row[0], 'user_id': row[1], 'user_name': row[2],
                                'entities': row[3], 'pairs': row[4],
                                'visible': bool(row[5]), 'from_current_user': row[1] == user_id})
-    return respond_with(user_documents)
+    response = respond_with(user_documents)
+    response.set_etag(etag)
+    return response
+
+
+def get_document_etag(kind, document_id, user_id):
+    """
+    Versions what user_id can see of a document by the user documents visible to them,
+    whose UPDATED_AT is bumped on every change, and by the type catalogue of the task.
+    """
+    cursor = get_connection().cursor()
+    cursor.execute('SELECT COUNT(*), MAX(UPDATED_AT) FROM LTN_DEVELOP.USER_DOCUMENTS '
+                   'WHERE DOCUMENT_ID = ? AND (VISIBILITY = 1 OR USER_ID = ?)', (document_id, user_id))
+    user_document_count, updated_at = cursor.fetchone()
+    cursor.close()
+    task_id = get_document_task(document_id)
+    type_version = get_type_catalogue(task_id).version if task_id is not None else None
+    return hashlib.md5(repr((kind, document_id, user_id, user_document_count, str(updated_at),
+                             type_version))).hexdigest()
+
+
+def not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
 
 
 @app.route('/userdoc_visibility/<doc_id>', methods=['POST'])
 def save_userdoc_visibility(doc_id):
     user_doc_id = load_user_doc_id(doc_id, current_user.get_id())
     visibility = request.get_json()['visible']
-    cursor = get_connection().cursor()
-    cursor.execute('UPDATE LTN_DEVELOP.USER_DOCUMENTS '
-                   'SET VISIBILITY = ? WHERE ID = ?',
-                   (visibility, user_doc_id))
-    cursor.close()
-    get_connection().commit()
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute('UPDATE LTN_DEVELOP.USER_DOCUMENTS '
+                       'SET VISIBILITY = ?, UPDATED_AT = ? WHERE ID = ?',
+                       (visibility, datetime.now(), user_doc_id))
+        cursor.close()
     return "", 200
 
 
@@ -68,14 +109,28 @@ def manage_user_documents(user_document_id):
             return 'Deleted.', 200
 
 
-@app.route('/documents/<document_id>', methods=['GET', 'POST', 'DELETE'])
+@app.route('/documents/<document_id>', methods=['GET', 'POST', 'PATCH', 'DELETE'])
 def get_document(document_id):
-    if get_connection() is None:
-        try_reconnecting()
     if request.method == 'GET':
         try:
-            result = load_document(document_id, current_user.get_id())
-            return respond_with(result)
+            etag = get_document_etag('document', document_id, current_user.get_id())
+            if request.if_none_match.contains_weak(etag):
+                return not_modified(etag)
+            if request.args.get('stream') in ['true', '1']:
+                # keeps the request context and its connection until the whole response is sent
+                response = Response(stream_with_context(stream_document(document_id, current_user.get_id())),
+                                    mimetype='application/json')
+                response.set_etag(etag)
+                return response
+            timings = {}
+            result = load_document(document_id, current_user.get_id(), timings=timings)
+            if request.args.get('format') == 'compact':
+                result = compact_document(result)
+            response = respond_with(result)
+            response.set_etag(etag)
+            response.headers['Server-Timing'] = ', '.join('%s;dur=%.1f' % (name.replace(' ', '-'), duration)
+                                                          for name, duration in sorted(timings.items()))
+            return response
         except Exception, e:
             print e
             reset_connection()
@@ -88,7 +143,23 @@ def get_document(document_id):
                                        request.get_json()['task_id'])
         except Exception, e:
             print e
-            reset_connection()
+        if successful:
+            return ""
+        else:
+            return "An error occurred while saving the document.", 500
+    if request.method == 'PATCH':
+        successful = False
+        req = request.get_json(silent=True)
+        if not isinstance(req, dict) or 'operations' not in req or 'task_id' not in req:
+            return "A patch needs the task_id and a list of operations.", 400
+        try:
+            user_doc_id = load_user_doc_id(document_id, current_user.get_id())
+            successful = patch_document(req['operations'], user_doc_id, document_id, current_user.get_id(),
+                                        req['task_id'])
+        except InvalidOperation, e:
+            return str(e), 400
+        except Exception, e:
+            print e
         if successful:
             return ""
         else:
@@ -99,62 +170,122 @@ def get_document(document_id):
             successful = delete_document(document_id)
         except Exception, e:
             print e
-            reset_connection()
         if not successful:
             return 'Deletion unsuccessful.', 500
         else:
             return 'Deleted.', 200
 
 
+@app.route('/documents/batch', methods=['POST'])
+def get_documents():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return 'The request body must be a JSON object.', 400
+    document_ids = data.get('document_ids', [])
+    if not isinstance(document_ids, list) or not all(isinstance(document_id, basestring)
+                                                     for document_id in document_ids):
+        return 'document_ids must be a list of document ids.', 400
+    if len(document_ids) > MAX_BATCH_SIZE:
+        return 'At most %d documents can be loaded at once.' % MAX_BATCH_SIZE, 400
+    try:
+        documents = load_documents(document_ids, current_user.get_id())
+    except Exception, e:
+        print e
+        reset_connection()
+        return 'Error while loading the documents.', 500
+    if data.get('format') == 'compact':
+        documents = map(compact_document, documents)
+    found = set(document['sourceid'] for document in documents)
+    return respond_with({'documents': documents,
+                         'missing': [document_id for document_id in document_ids if document_id not in found]})
+
+
 def save_document(data, user_doc_id, document_id, user_id, task_id, is_visible=True):
+    if not user_doc_id:
+        return False
+    if data.get('format') == 'compact':
+        data = expand_document(data)
     annotations = data['denotations']
-    successful = True
-    create_user_doc_if_not_existent(user_doc_id, document_id, user_id, is_visible)
-    delete_annotation_data(user_doc_id)
     print "Did load user_doc_id: " + str(user_doc_id)
-    successful &= save_annotations(user_doc_id, annotations)
-    if successful:
-        print "saved annotations successfully"
-        id_map = {}
-        # necessary, as TextAE does not create "originalId"s
-        for annotation in annotations:
-            if annotation.get('userId', 0) == 0:
-                id_map[annotation['id']] = annotation.get('originalId', annotation['id'])
-        print "saving relations"
-        successful &= save_relations(user_doc_id, data['relations'], id_map)
-        if successful:
-            print "saved relations successfully"
-            model_training_queue.add(task_id)
-        else:
-            print "did not save relations successfully"
-    else:
-        print "did not save annotations successfully"
-    return successful
+    id_map = get_id_map(annotations)
+    with transaction() as connection:
+        create_user_doc_if_not_existent(user_doc_id, document_id, user_id, is_visible)
+        cursor = connection.cursor()
+        entities, offsets = get_submitted_annotations(user_doc_id, annotations)
+        stored_entities, stored_offsets = get_stored_annotations(cursor, user_doc_id)
+        pairs = convert_relations(user_doc_id, data['relations'], id_map)
+        stored_pairs = get_stored_relations(cursor, user_doc_id)
+        changes = Changes()
+        diff_annotations(changes, stored_entities, stored_offsets, entities, offsets)
+        diff_relations(changes, stored_pairs, pairs)
+        apply_changes(cursor, user_doc_id, changes)
+        touch_user_document(cursor, user_doc_id)
+        cursor.close()
+    print "saved changes successfully"
+    model_training_queue.add(task_id)
+    if tracks_annotations():
+        update_tagger(task_id, document_id, user_id, count_spans(stored_entities, stored_offsets),
+                      count_spans(entities, offsets))
+    return True
+
+
+def tracks_annotations():
+    # the tagger depends on this module
+    from ltnserver.tagger import is_enabled
+    return is_enabled()
+
+
+def count_spans(entities, offsets):
+    """Counts the (start, end, type id) spans annotated by the given entities and their offsets."""
+    spans = Counter()
+    for entity_id, entity in entities.iteritems():
+        for offset in offsets.get(entity_id, ()):
+            spans[(int(offset[0]), int(offset[1]), normalize(entity[2]))] += 1
+    return spans
+
+
+def update_tagger(task_id, document_id, user_id, stored_spans, spans, text=None):
+    from ltnserver.tagger import record_annotations
+    try:
+        record_annotations(task_id, document_id, user_id, spans - stored_spans, stored_spans - spans, text)
+    except Exception, e:
+        print 'Could not update the dictionary of task %s: ' % task_id, e
+
+
+def clone_user_document(source_user_doc_id, target_user_doc_id, document_id, user_id, is_visible=True):
+    """Copies the annotations of one user document into another, empty one without leaving the database."""
+    with transaction() as connection:
+        create_user_doc_if_not_existent(target_user_doc_id, document_id, user_id, is_visible)
+        cursor = connection.cursor()
+        cursor.execute('INSERT INTO LTN_DEVELOP.ENTITIES (ID, USER_DOC_ID, TYPE_ID, LABEL, TEXT) '
+                       'SELECT ID, ?, TYPE_ID, LABEL, TEXT FROM LTN_DEVELOP.ENTITIES WHERE USER_DOC_ID = ?',
+                       (target_user_doc_id, source_user_doc_id))
+        cursor.execute('INSERT INTO LTN_DEVELOP.OFFSETS ("START", "END", ENTITY_ID, USER_DOC_ID) '
+                       'SELECT "START", "END", ENTITY_ID, ? FROM LTN_DEVELOP.OFFSETS WHERE USER_DOC_ID = ?',
+                       (target_user_doc_id, source_user_doc_id))
+        cursor.execute('INSERT INTO LTN_DEVELOP.PAIRS (E1_ID, E2_ID, USER_DOC_ID, DDI, TYPE_ID, LABEL) '
+                       'SELECT E1_ID, E2_ID, ?, DDI, TYPE_ID, LABEL FROM LTN_DEVELOP.PAIRS WHERE USER_DOC_ID = ?',
+                       (target_user_doc_id, source_user_doc_id))
+        touch_user_document(cursor, target_user_doc_id)
+        cursor.close()
+    return True
 
 
 def create_user_doc_if_not_existent(user_doc_id, document_id, user_id, is_visible=True):
-    cursor = get_connection().cursor()
-    cursor.execute("SELECT 1 FROM LTN_DEVELOP.USER_DOCUMENTS WHERE ID = ?", (user_doc_id,))
-    result = cursor.fetchone()
-    if not result:
-        date = datetime.now()
-        cursor.execute("INSERT INTO LTN_DEVELOP.USER_DOCUMENTS VALUES (?, ?, ?, ?, ?, ?)",
-                       (user_doc_id, user_id, document_id, int(is_visible), date, date))
-        get_connection().commit()
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT 1 FROM LTN_DEVELOP.USER_DOCUMENTS WHERE ID = ?", (user_doc_id,))
+        result = cursor.fetchone()
+        if not result:
+            date = datetime.now()
+            cursor.execute("INSERT INTO LTN_DEVELOP.USER_DOCUMENTS VALUES (?, ?, ?, ?, ?, ?)",
+                           (user_doc_id, user_id, document_id, int(is_visible), date, date))
+        cursor.close()
 
 
-def delete_annotation_data(user_doc_id):
-    cursor = get_connection().cursor()
-    print "Deleting old information for " + str(user_doc_id) + "..."
-    print "Deleting existing pairs..."
-    cursor.execute("DELETE FROM LTN_DEVELOP.PAIRS WHERE USER_DOC_ID = ?", (user_doc_id,))
-    get_connection().commit()
-    print "Deleting existing offsets..."
-    cursor.execute("DELETE FROM LTN_DEVELOP.OFFSETS WHERE USER_DOC_ID = ?", (user_doc_id,))
-    get_connection().commit()
-    print "Deleting existing annotations..."
-    cursor.execute("DELETE FROM LTN_DEVELOP.ENTITIES WHERE USER_DOC_ID = ?", (user_doc_id,))
-    get_connection().commit()
+def touch_user_document(cursor, user_doc_id):
+    # UPDATED_AT versions the document for conditional requests
+    cursor.execute("UPDATE LTN_DEVELOP.USER_DOCUMENTS SET UPDATED_AT = ? WHERE ID = ?", (datetime.now(), user_doc_id))
 
 
 def convert_annotation(annotation, user_doc_id):
@@ -170,24 +301,16 @@ def convert_offset(annotation, user_doc_id):
             annotation.get('originalId', annotation['id']), user_doc_id)
 
 
-def save_annotations(user_doc_id, annotations):
-    # only save annotations from the current user, defined as userId 0 at loading time
-    filtered_annotations = filter(lambda annotation: annotation.get('userId', 0) == 0, annotations)
-    if not user_doc_id:
-        return False
-    print "inserting new annotations..."
-    annotation_tuples = map(lambda annotation: convert_annotation(annotation, user_doc_id), filtered_annotations)
-    cursor = get_connection().cursor()
-    cursor.executemany("INSERT INTO LTN_DEVELOP.ENTITIES (ID, USER_DOC_ID, TYPE_ID, LABEL) "
-                       "VALUES (?, ?, ?, ?)", annotation_tuples)
-    print "inserting new offsets..."
-    offset_tuples = map(lambda annotation: convert_offset(annotation, user_doc_id), filtered_annotations)
-    cursor.executemany("INSERT INTO LTN_DEVELOP.OFFSETS VALUES (?, ?, ?, ?)", offset_tuples)
-    get_connection().commit()
-    return True
+def get_id_map(annotations):
+    id_map = {}
+    # necessary, as TextAE does not create "originalId"s
+    for annotation in annotations:
+        if annotation.get('userId', 0) == 0:
+            id_map[annotation['id']] = annotation.get('originalId', annotation['id'])
+    return id_map
 
 
-def save_relations(user_doc_id, relations, id_map):
+def convert_relations(user_doc_id, relations, id_map):
     relation_tuples = list()
     for relation in relations:
         if id_map.get(relation['subj']) is not None and id_map.get(relation['obj']) is not None:
@@ -196,14 +319,283 @@ def save_relations(user_doc_id, relations, id_map):
                                     user_doc_id, 1,
                                     relation['pred'].get('id'),
                                     relation['pred'].get('label', None)))
+    return relation_tuples
 
-    cursor = get_connection().cursor()
-    cursor.executemany("INSERT INTO LTN_DEVELOP.PAIRS (E1_ID, E2_ID, USER_DOC_ID, DDI, TYPE_ID, LABEL) "
-                       "VALUES (?, ?, ?, ?, ?, ?)", relation_tuples)
-    get_connection().commit()
+
+def normalize(value):
+    # ids and labels come back from the frontend as strings, missing ones as 'None'
+    if value is None or unicode(value) == u'None':
+        return None
+    return unicode(value)
+
+
+def get_submitted_annotations(user_doc_id, annotations):
+    # only save annotations from the current user, defined as userId 0 at loading time
+    entities = {}
+    offsets = {}
+    for annotation in filter(lambda a: a.get('userId', 0) == 0, annotations):
+        entity = convert_annotation(annotation, user_doc_id)
+        entities[entity[0]] = entity
+        offsets.setdefault(entity[0], set()).add(convert_offset(annotation, user_doc_id))
+    return entities, offsets
+
+
+def get_stored_annotations(cursor, user_doc_id):
+    cursor.execute('SELECT E.ID, E.TYPE_ID, E.LABEL, O."START", O."END" '
+                   'FROM LTN_DEVELOP.ENTITIES E '
+                   'LEFT OUTER JOIN LTN_DEVELOP.OFFSETS O ON O.ENTITY_ID = E.ID AND O.USER_DOC_ID = E.USER_DOC_ID '
+                   'WHERE E.USER_DOC_ID = ?', (user_doc_id,))
+    entities = {}
+    offsets = {}
+    for row in cursor.fetchall():
+        entities[row[0]] = (row[0], user_doc_id, row[1], row[2])
+        offsets.setdefault(row[0], set())
+        if row[3] is not None:
+            offsets[row[0]].add((row[3], row[4], row[0], user_doc_id))
+    return entities, offsets
+
+
+def get_stored_relations(cursor, user_doc_id):
+    cursor.execute('SELECT ID, E1_ID, E2_ID, DDI, TYPE_ID, LABEL FROM LTN_DEVELOP.PAIRS WHERE USER_DOC_ID = ?',
+                   (user_doc_id,))
+    return cursor.fetchall()
+
+
+class Changes:
+
+    def __init__(self):
+        self.deleted_entities = []
+        self.updated_entities = []
+        self.inserted_entities = []
+        self.deleted_offsets = []
+        self.inserted_offsets = []
+        self.deleted_pairs = []
+        self.updated_pairs = []
+        self.inserted_pairs = []
+
+
+def diff_annotations(changes, stored_entities, stored_offsets, entities, offsets):
+    for entity_id in stored_entities:
+        if entity_id not in entities:
+            changes.deleted_offsets.append(entity_id)
+            changes.deleted_entities.append(entity_id)
+    for entity_id, entity in entities.iteritems():
+        stored_entity = stored_entities.get(entity_id)
+        if stored_entity is None:
+            changes.inserted_entities.append(entity)
+            changes.inserted_offsets.extend(offsets[entity_id])
+            continue
+        if map(normalize, stored_entity[2:]) != map(normalize, entity[2:]):
+            changes.updated_entities.append((entity[2], entity[3], entity_id))
+        if stored_offsets[entity_id] != offsets[entity_id]:
+            changes.deleted_offsets.append(entity_id)
+            changes.inserted_offsets.extend(offsets[entity_id])
+
+
+def relation_key(e1_id, e2_id, ddi, type_id, label):
+    return e1_id, e2_id, ddi, normalize(type_id), normalize(label)
+
+
+def diff_relations(changes, stored_pairs, pairs):
+    # identical pairs may occur multiple times, so they are matched one by one
+    stored_ids = {}
+    for row in stored_pairs:
+        stored_ids.setdefault(relation_key(*row[1:]), []).append(row[0])
+    for pair in pairs:
+        matching_ids = stored_ids.get(relation_key(pair[0], pair[1], pair[3], pair[4], pair[5]))
+        if matching_ids:
+            matching_ids.pop()
+        else:
+            changes.inserted_pairs.append(pair)
+    for ids in stored_ids.itervalues():
+        changes.deleted_pairs.extend(ids)
+
+
+def apply_changes(cursor, user_doc_id, changes):
+    print "Applying changes to %s: entities +%d ~%d -%d, offsets +%d -%d, pairs +%d ~%d -%d" % \
+        (user_doc_id, len(changes.inserted_entities), len(changes.updated_entities), len(changes.deleted_entities),
+         len(changes.inserted_offsets), len(changes.deleted_offsets),
+         len(changes.inserted_pairs), len(changes.updated_pairs), len(changes.deleted_pairs))
+    if changes.deleted_entities:
+        cursor.executemany("DELETE FROM LTN_DEVELOP.PAIRS WHERE USER_DOC_ID = ? AND (E1_ID = ? OR E2_ID = ?)",
+                           [(user_doc_id, entity_id, entity_id) for entity_id in changes.deleted_entities])
+    if changes.deleted_pairs:
+        cursor.executemany("DELETE FROM LTN_DEVELOP.PAIRS WHERE ID = ? AND USER_DOC_ID = ?",
+                           [(pair_id, user_doc_id) for pair_id in changes.deleted_pairs])
+    if changes.deleted_offsets:
+        cursor.executemany("DELETE FROM LTN_DEVELOP.OFFSETS WHERE USER_DOC_ID = ? AND ENTITY_ID = ?",
+                           [(user_doc_id, entity_id) for entity_id in changes.deleted_offsets])
+    if changes.deleted_entities:
+        cursor.executemany("DELETE FROM LTN_DEVELOP.ENTITIES WHERE USER_DOC_ID = ? AND ID = ?",
+                           [(user_doc_id, entity_id) for entity_id in changes.deleted_entities])
+    if changes.updated_entities:
+        cursor.executemany("UPDATE LTN_DEVELOP.ENTITIES SET TYPE_ID = ?, LABEL = ? WHERE ID = ? AND USER_DOC_ID = ?",
+                           [update + (user_doc_id,) for update in changes.updated_entities])
+    if changes.updated_pairs:
+        cursor.executemany("UPDATE LTN_DEVELOP.PAIRS SET TYPE_ID = ?, LABEL = ? WHERE ID = ? AND USER_DOC_ID = ?",
+                           [update + (user_doc_id,) for update in changes.updated_pairs])
+    if changes.inserted_entities:
+        cursor.executemany("INSERT INTO LTN_DEVELOP.ENTITIES (ID, USER_DOC_ID, TYPE_ID, LABEL) "
+                           "VALUES (?, ?, ?, ?)", changes.inserted_entities)
+    if changes.inserted_offsets:
+        cursor.executemany("INSERT INTO LTN_DEVELOP.OFFSETS VALUES (?, ?, ?, ?)", changes.inserted_offsets)
+    if changes.inserted_pairs:
+        cursor.executemany("INSERT INTO LTN_DEVELOP.PAIRS (E1_ID, E2_ID, USER_DOC_ID, DDI, TYPE_ID, LABEL) "
+                           "VALUES (?, ?, ?, ?, ?, ?)", changes.inserted_pairs)
+
+
+class InvalidOperation(ValueError):
+    pass
+
+
+class PatchedEntity:
+    """What has to change in the database for an entity, after the operations applied to it so far."""
+
+    def __init__(self, stored):
+        self.stored = stored
+        self.exists = stored
+        self.delete_stored = False
+        self.delete_offsets = False
+        self.insert = None
+        self.update = None
+        self.offsets = []
+
+
+def patch_document(operations, user_doc_id, document_id, user_id, task_id):
+    """
+    Applies a list of operations instead of the whole document state. Each operation is
+    {'op': 'add' | 'modify' | 'remove', 'denotation': {...}} or {'op': ..., 'relation': {...}},
+    where denotations are given as in save_document and relations reference the ids of the stored entities.
+    The operations take effect in the given order, invalid ones raise InvalidOperation and nothing is saved.
+    """
+    with transaction() as connection:
+        create_user_doc_if_not_existent(user_doc_id, document_id, user_id)
+        cursor = connection.cursor()
+        tracked = tracks_annotations()
+        if tracked:
+            # the operations only carry the ids of what they remove
+            stored_spans = count_spans(*get_stored_annotations(cursor, user_doc_id))
+        changes = collect_changes(cursor, operations, user_doc_id)
+        apply_changes(cursor, user_doc_id, changes)
+        if tracked:
+            spans = count_spans(*get_stored_annotations(cursor, user_doc_id))
+        touch_user_document(cursor, user_doc_id)
+        cursor.close()
+    model_training_queue.add(task_id)
+    if tracked:
+        update_tagger(task_id, document_id, user_id, stored_spans, spans)
     return True
 
 
+def collect_changes(cursor, operations, user_doc_id):
+    """Merges the operations per entity and relation, so they can be applied with one statement per kind."""
+    if not isinstance(operations, list):
+        raise InvalidOperation('operations must be a list')
+    cursor.execute('SELECT ID FROM LTN_DEVELOP.ENTITIES WHERE USER_DOC_ID = ?', (user_doc_id,))
+    stored_entities = set(map(lambda row: row[0], cursor.fetchall()))
+    entities = OrderedDict()
+    stored_pairs = None
+    changes = Changes()
+
+    def entity(entity_id):
+        if entity_id not in entities:
+            entities[entity_id] = PatchedEntity(entity_id in stored_entities)
+        return entities[entity_id]
+
+    def is_stored_pair_alive(pair_id):
+        if pair_id not in stored_pairs or pair_id in changes.deleted_pairs:
+            return False
+        return not any(entity(entity_id).delete_stored for entity_id in stored_pairs[pair_id])
+
+    for operation in operations:
+        op = operation.get('op') if isinstance(operation, dict) else None
+        if op not in ['add', 'modify', 'remove']:
+            raise InvalidOperation('Unknown operation: %s' % (op,))
+        if isinstance(operation.get('denotation'), dict):
+            denotation = operation['denotation']
+            if denotation.get('id') is None:
+                raise InvalidOperation('Denotations need an id')
+            if 'obj' in denotation and not isinstance(denotation['obj'], dict):
+                raise InvalidOperation('The obj of a denotation must be an object')
+            if 'span' in denotation and not is_span(denotation['span']):
+                raise InvalidOperation('The span of a denotation needs a begin and an end')
+            entity_id = denotation.get('originalId', denotation['id'])
+            state = entity(entity_id)
+            if op == 'add':
+                if 'span' not in denotation:
+                    raise InvalidOperation('Added denotations need a span')
+                if not state.exists:
+                    if 'obj' not in denotation:
+                        raise InvalidOperation('New denotation %s needs an obj' % entity_id)
+                    state.exists = True
+                    state.insert = convert_annotation(denotation, user_doc_id)
+                state.offsets.append(convert_offset(denotation, user_doc_id))
+                continue
+            if not state.exists:
+                raise InvalidOperation('Unknown denotation: %s' % entity_id)
+            if op == 'modify':
+                if 'obj' in denotation:
+                    converted = convert_annotation(denotation, user_doc_id)
+                    if state.insert is not None:
+                        state.insert = converted
+                    else:
+                        state.update = (converted[2], converted[3], entity_id)
+                if 'span' in denotation:
+                    state.delete_offsets = state.stored
+                    state.offsets = [convert_offset(denotation, user_doc_id)]
+            else:
+                state.exists = False
+                state.insert = None
+                state.update = None
+                state.offsets = []
+                if state.stored:
+                    state.delete_stored = True
+                    state.delete_offsets = True
+                changes.inserted_pairs = [pair for pair in changes.inserted_pairs if entity_id not in pair[:2]]
+        elif isinstance(operation.get('relation'), dict):
+            relation = operation['relation']
+            if op == 'add':
+                if not isinstance(relation.get('pred'), dict):
+                    raise InvalidOperation('Added relations need a pred')
+                for entity_id in [relation.get('subj'), relation.get('obj')]:
+                    if entity_id is None or not entity(entity_id).exists:
+                        raise InvalidOperation('Unknown denotation: %s' % (entity_id,))
+                changes.inserted_pairs.append((relation['subj'], relation['obj'], user_doc_id, 1,
+                                               relation['pred'].get('id'), relation['pred'].get('label', None)))
+                continue
+            if stored_pairs is None:
+                cursor.execute('SELECT ID, E1_ID, E2_ID FROM LTN_DEVELOP.PAIRS WHERE USER_DOC_ID = ?', (user_doc_id,))
+                stored_pairs = dict((normalize(row[0]), row[1:]) for row in cursor.fetchall())
+            pair_id = normalize(relation.get('id'))
+            if not is_stored_pair_alive(pair_id):
+                raise InvalidOperation('Unknown relation: %s' % (relation.get('id'),))
+            if op == 'modify':
+                if not isinstance(relation.get('pred'), dict):
+                    raise InvalidOperation('Modified relations need a pred')
+                changes.updated_pairs.append((relation['pred'].get('id'), relation['pred'].get('label', None),
+                                              pair_id))
+            else:
+                changes.deleted_pairs.append(pair_id)
+        else:
+            raise InvalidOperation('Operations need a denotation or a relation')
+
+    for entity_id, state in entities.iteritems():
+        if state.delete_stored:
+            changes.deleted_entities.append(entity_id)
+        if state.delete_offsets:
+            changes.deleted_offsets.append(entity_id)
+        if state.update is not None:
+            changes.updated_entities.append(state.update)
+        if state.insert is not None:
+            changes.inserted_entities.append(state.insert)
+        changes.inserted_offsets.extend(state.offsets)
+    return changes
+
+
+def is_span(span):
+    return isinstance(span, dict) and isinstance(span.get('begin'), int) and isinstance(span.get('end'), int)
+
+
 def create_new_user_doc_id(user_id, document_id):
     return str(user_id) + '_' + str(document_id)
 
@@ -218,42 +610,231 @@ def load_user_doc_id(document_id, user_id):
     return create_new_user_doc_id(user_id, document_id)
 
 
-def load_document(document_id, user_id, show_predictions=False):
-    cursor = get_connection().cursor()
+def load_document(document_id, user_id, show_predictions=False, timings=None):
     result = {}
     print "Loading information for document_id: '%s' and user: '%s'" % (document_id, user_id)
-    result['text'] = get_text(cursor, document_id)
-    denotations, users, annotation_id_map = get_denotations_and_users(cursor, document_id, user_id, show_predictions)
+    # the queries are independent of each other, so they run side by side
+    parts = run_queries({'text': lambda cursor: get_text(cursor, document_id),
+                         'denotations': lambda cursor: fetch_denotations(cursor, document_id, user_id,
+                                                                         show_predictions),
+                         'relations': lambda cursor: fetch_relations(cursor, document_id, user_id, show_predictions),
+                         'entity types': lambda cursor: get_entity_types(document_id),
+                         'relation types': lambda cursor: get_relation_types(document_id)}, timings)
+    result['text'] = parts['text']
+    denotations, users, annotation_id_map = get_denotations_and_users(parts['denotations'], user_id, show_predictions)
     result['denotations'] = denotations
-    result['relations'] = get_relations(cursor, document_id, user_id, annotation_id_map, show_predictions)
+    result['relations'] = get_relations(parts['relations'], annotation_id_map)
     result['sourceid'] = document_id
-    result['config'] = {'entity types': get_entity_types(document_id),
-                        'relation types': get_relation_types(document_id),
+    result['config'] = {'entity types': parts['entity types'],
+                        'relation types': parts['relation types'],
                         'users': users}
-    cursor.close()
     return result
 
 
+def load_documents(document_ids, user_id, show_predictions=False, timings=None):
+    """
+    Loads several documents like load_document, but with one query per kind of data for all of them.
+    The types are fetched once per task. Unknown documents are left out.
+    """
+    from ltnserver.prediction import get_current_prediction_user
+    current_prediction_user = get_current_prediction_user(user_id, show_predictions)
+    document_ids = list(OrderedDict.fromkeys(document_ids))
+    if not document_ids:
+        return []
+    print "Loading information for %d documents and user: '%s'" % (len(document_ids), user_id)
+    parts = run_queries({'documents': lambda cursor: fetch_texts_and_tasks(cursor, document_ids),
+                         'denotations': lambda cursor: fetch_batch(cursor, DENOTATIONS_OF_DOCUMENTS, document_ids,
+                                                                   (user_id, current_prediction_user)),
+                         'relations': lambda cursor: fetch_batch(cursor, RELATIONS_OF_DOCUMENTS, document_ids,
+                                                                 (user_id, current_prediction_user) * 2)}, timings)
+    denotation_rows = group_by_document(parts['denotations'])
+    relation_rows = group_by_document(parts['relations'])
+    types_of_tasks = {}
+    documents = []
+    for document_id in document_ids:
+        if document_id not in parts['documents']:
+            continue
+        text, task_id = parts['documents'][document_id]
+        if task_id not in types_of_tasks:
+            types_of_tasks[task_id] = (get_types_of_task(task_id, relation=False),
+                                       get_types_of_task(task_id, relation=True))
+        entity_types, relation_types = types_of_tasks[task_id]
+        denotations, users, annotation_id_map = get_denotations_and_users(denotation_rows.get(document_id, []),
+                                                                          user_id, show_predictions)
+        documents.append({'sourceid': document_id,
+                          'text': text,
+                          'denotations': denotations,
+                          'relations': get_relations(relation_rows.get(document_id, []), annotation_id_map),
+                          'config': {'entity types': entity_types,
+                                     'relation types': relation_types,
+                                     'users': users}})
+    return documents
+
+
+def fetch_texts_and_tasks(cursor, document_ids):
+    documents = {}
+    missing = []
+    for document_id in document_ids:
+        text = document_texts.get(document_id)
+        task_id = document_tasks.get(document_id)
+        if text is None or task_id is None:
+            missing.append(document_id)
+        else:
+            documents[document_id] = (text, task_id)
+    for chunk in chunks(missing, MAX_BATCH_SIZE):
+        cursor.execute('SELECT ID, TEXT, TASK FROM LTN_DEVELOP.DOCUMENTS WHERE ID IN (%s)' % placeholders(chunk),
+                       chunk)
+        for document_id, text, task_id in cursor.fetchall():
+            text = text.read() if text is not None else None
+            document_texts.put(document_id, text)
+            if task_id is not None:
+                document_tasks.put(document_id, task_id)
+            documents[document_id] = (text, task_id)
+    return documents
+
+
+# the same queries as query_denotations and query_relations, with the document id as additional last column
+DENOTATIONS_OF_DOCUMENTS = 'SELECT E.ID, UD.USER_ID, O."START", O."END", T.CODE, TT."LABEL", T.GROUP_ID, ' \
+                           'T."GROUP", E."LABEL", U."NAME", TT.ID, UD.DOCUMENT_ID ' \
+                           'FROM LTN_DEVELOP.ENTITIES E ' \
+                           'JOIN LTN_DEVELOP.USER_DOCUMENTS UD ON E.USER_DOC_ID = UD.ID ' \
+                           'AND UD.DOCUMENT_ID IN (%s) ' \
+                           'JOIN LTN_DEVELOP.OFFSETS O ON O.ENTITY_ID = E.ID AND O.USER_DOC_ID = E.USER_DOC_ID ' \
+                           'LEFT OUTER JOIN LTN_DEVELOP.USERS U ON UD.USER_ID = U.ID ' \
+                           'LEFT OUTER JOIN LTN_DEVELOP.TASK_TYPES TT ON E.TYPE_ID = TT.ID ' \
+                           'LEFT OUTER JOIN LTN_DEVELOP.TYPES T ON TT.TYPE_ID = T.ID ' \
+                           'WHERE UD.VISIBILITY = 1 OR UD.USER_ID = ? OR UD.USER_ID = ? ' \
+                           'ORDER BY UD.DOCUMENT_ID, E.ID'
+
+RELATIONS_OF_DOCUMENTS = 'SELECT P.ID, P.E1_ID, P.E2_ID, P.LABEL, T.CODE, TT.LABEL, ' \
+                         'T.GROUP_ID, T."GROUP", UD1.USER_ID, TT.ID, UD1.DOCUMENT_ID ' \
+                         'FROM LTN_DEVELOP.PAIRS P ' \
+                         'LEFT OUTER JOIN LTN_DEVELOP.TASK_TYPES TT ON P.TYPE_ID = TT.ID ' \
+                         'JOIN LTN_DEVELOP.TYPES T ON TT.TYPE_ID = T.ID ' \
+                         'JOIN LTN_DEVELOP.ENTITIES E1 ON P.E1_ID = E1.ID AND P.DDI = 1 ' \
+                         'AND P.USER_DOC_ID = E1.USER_DOC_ID ' \
+                         'JOIN LTN_DEVELOP.ENTITIES E2 ON P.E2_ID = E2.ID AND P.DDI = 1 ' \
+                         'AND P.USER_DOC_ID = E2.USER_DOC_ID ' \
+                         'JOIN LTN_DEVELOP.USER_DOCUMENTS UD1 ON E1.USER_DOC_ID = UD1.ID ' \
+                         'AND UD1.DOCUMENT_ID IN (%s) ' \
+                         'JOIN LTN_DEVELOP.USER_DOCUMENTS UD2 ON E2.USER_DOC_ID = UD2.ID ' \
+                         'AND UD2.DOCUMENT_ID = UD1.DOCUMENT_ID ' \
+                         'WHERE (UD1.USER_ID = ? OR UD1.USER_ID = ? OR UD1.VISIBILITY = 1) ' \
+                         'AND (UD2.USER_ID = ? OR UD2.USER_ID = ? OR UD2.VISIBILITY = 1)'
+
+
+def fetch_batch(cursor, sql, document_ids, parameters):
+    rows = []
+    for chunk in chunks(document_ids, MAX_BATCH_SIZE):
+        cursor.execute(sql % placeholders(chunk), tuple(chunk) + parameters)
+        rows.extend(cursor.fetchall())
+    return rows
+
+
+def group_by_document(rows):
+    grouped = {}
+    for row in rows:
+        grouped.setdefault(row[-1], []).append(row)
+    return grouped
+
+
+def chunks(values, size):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def placeholders(values):
+    return ', '.join('?' * len(values))
+
+
+def compact_document(document):
+    """
+    Converts a loaded document to the compact format: every distinct obj/pred dict is sent once in 'types',
+    denotations and relations become parallel arrays that reference them by index.
+    """
+    types = []
+    type_indices = {}
+
+    def type_index(type_info):
+        key = tuple(sorted(type_info.items()))
+        if key not in type_indices:
+            type_indices[key] = len(types)
+            types.append(type_info)
+        return type_indices[key]
+
+    denotations = {'id': [], 'originalId': [], 'begin': [], 'end': [], 'type': [], 'userId': []}
+    for denotation in document['denotations']:
+        denotations['id'].append(denotation['id'])
+        denotations['originalId'].append(denotation['originalId'])
+        denotations['begin'].append(denotation['span']['begin'])
+        denotations['end'].append(denotation['span']['end'])
+        denotations['type'].append(type_index(denotation['obj']))
+        denotations['userId'].append(denotation['userId'])
+    relations = {'id': [], 'subj': [], 'obj': [], 'type': []}
+    for relation in document['relations']:
+        relations['id'].append(relation['id'])
+        relations['subj'].append(relation['subj'])
+        relations['obj'].append(relation['obj'])
+        relations['type'].append(type_index(relation['pred']))
+    return {'format': 'compact',
+            'sourceid': document['sourceid'],
+            'text': document['text'],
+            'types': types,
+            'denotations': denotations,
+            'relations': relations,
+            'config': document['config']}
+
+
+def expand_document(data):
+    """Converts a document in the compact format back to the format accepted by save_document."""
+    types = data['types']
+    columns = data['denotations']
+    denotations = []
+    for index, annotation_id in enumerate(columns['id']):
+        denotation = {'id': annotation_id,
+                      'span': {'begin': columns['begin'][index], 'end': columns['end'][index]},
+                      'obj': types[columns['type'][index]],
+                      'userId': columns['userId'][index] if 'userId' in columns else 0}
+        if 'originalId' in columns:
+            denotation['originalId'] = columns['originalId'][index]
+        denotations.append(denotation)
+    columns = data['relations']
+    relations = [{'id': relation_id,
+                  'subj': columns['subj'][index],
+                  'obj': columns['obj'][index],
+                  'pred': types[columns['type'][index]]} for index, relation_id in enumerate(columns['id'])]
+    expanded = dict(data)
+    expanded['denotations'] = denotations
+    expanded['relations'] = relations
+    return expanded
+
+
 def get_text(cursor, document_id):
-    text = None
+    text = document_texts.get(document_id)
+    if text is not None:
+        return text
     try:
         sql_to_prepare = 'CALL LTN_DEVELOP.get_document_content (?, ?)'
         params = {
             'DOCUMENT_ID': document_id,
             'TEXT': ''
         }
-        psid = cursor.prepare(sql_to_prepare)
-        ps = cursor.get_prepared_statement(psid)
-        cursor.execute_prepared(ps, [params])
+        execute_prepared(cursor, sql_to_prepare, params)
         result = cursor.fetchone()
         if result:
             text = result[0].read()
+            document_texts.put(document_id, text)
     except Exception, e:
         print 'Error: ', e
     return text
 
 
-def get_denotations_and_users(cursor, document_id, user_id, show_predictions):
+def fetch_denotations(cursor, document_id, user_id, show_predictions):
+    query_denotations(cursor, document_id, user_id, show_predictions)
+    return cursor.fetchall()
+
+
+def query_denotations(cursor, document_id, user_id, show_predictions):
     from ltnserver.prediction import get_current_prediction_user
     current_prediction_user = get_current_prediction_user(user_id, show_predictions)
     cursor.execute('SELECT E.ID, UD.USER_ID, O."START", O."END", T.CODE, TT."LABEL", T.GROUP_ID, '
@@ -266,7 +847,19 @@ def get_denotations_and_users(cursor, document_id, user_id, show_predictions):
                    'LEFT OUTER JOIN LTN_DEVELOP.TYPES T ON TT.TYPE_ID = T.ID '
                    'WHERE UD.VISIBILITY = 1 OR UD.USER_ID = ? OR UD.USER_ID = ? '
                    'ORDER BY E.ID', (document_id, user_id, current_prediction_user))
-    denotations = []
+
+
+def get_denotations_and_users(rows, user_id, show_predictions):
+    user_info = {}
+    annotation_id_map = {}
+    denotations = list(iterate_denotations(rows, user_id, show_predictions, user_info, annotation_id_map))
+    return denotations, user_info, annotation_id_map
+
+
+def iterate_denotations(rows, user_id, show_predictions, user_info, annotation_id_map):
+    """Converts the rows to denotations one by one, filling user_info and annotation_id_map on the way."""
+    from ltnserver.prediction import get_current_prediction_user
+    current_prediction_user = get_current_prediction_user(user_id, show_predictions)
     increment = 1
     previous_id = None
     # todo: handle being not logged in
@@ -274,14 +867,13 @@ def get_denotations_and_users(cursor, document_id, user_id, show_predictions):
     user_id_mapping = {user_id: 0}
     prediction_engine_info = {'name': 'Prediction Engine', 'color': 'gray'}
     current_user_info = {'name': 'You', 'color': '#55AA55'}
-    user_info = {0: current_user_info}
-    annotation_id_map = {}
+    user_info[0] = current_user_info
     user_offset = 1
     if current_prediction_user != user_id:
         user_info[-1] = prediction_engine_info
         user_id_mapping[current_prediction_user] = -1
         user_offset = 2
-    for result in cursor.fetchall():
+    for result in rows:
         denotation = {}
         current_id = str(result[0])
         creator = str(result[1])
@@ -313,12 +905,16 @@ def get_denotations_and_users(cursor, document_id, user_id, show_predictions):
         # necessary for split annotations
         denotation['originalId'] = str(result[0])
         denotation['userId'] = user_id_mapping.get(creator)
-        denotations.append(denotation)
         previous_id = str(result[0])
-    return denotations, user_info, annotation_id_map
+        yield denotation
+
 
+def fetch_relations(cursor, document_id, user_id, show_predictions):
+    query_relations(cursor, document_id, user_id, show_predictions)
+    return cursor.fetchall()
 
-def get_relations(cursor, document_id, user_id, annotation_id_map, show_predictions):
+
+def query_relations(cursor, document_id, user_id, show_predictions):
     from ltnserver.prediction import get_current_prediction_user
     current_prediction_user = get_current_prediction_user(user_id, show_predictions)
     cursor.execute('SELECT P.ID, P.E1_ID, P.E2_ID, P.LABEL, T.CODE, TT.LABEL, '
@@ -334,8 +930,14 @@ def get_relations(cursor, document_id, user_id, annotation_id_map, show_predicti
                    'AND (UD2.USER_ID = ? OR UD2.USER_ID = ? OR UD2.VISIBILITY = 1)',
                    (document_id, user_id, current_prediction_user,
                     document_id, user_id, current_prediction_user))
-    relations = []
-    for result in cursor.fetchall():
+
+
+def get_relations(rows, annotation_id_map):
+    return list(iterate_relations(rows, annotation_id_map))
+
+
+def iterate_relations(rows, annotation_id_map):
+    for result in rows:
         # the bioc library expects all attributes to be strings (and TextAE doesn't care)
         type_info = {"id": str(result[9]),
                      "code": str(result[4]),
@@ -359,52 +961,163 @@ def get_relations(cursor, document_id, user_id, annotation_id_map, show_predicti
         relation['subj'] = subj
         relation['obj'] = obj
         relation['pred'] = type_info
-        relations.append(relation)
-    return relations
+        yield relation
+
+
+def iterate_rows(cursor, batch_size=1000):
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        for row in rows:
+            yield row
+
+
+def encode_items(items, batch_size=500):
+    separator = ''
+    batch = []
+    for item in items:
+        batch.append(json.dumps(item))
+        if len(batch) == batch_size:
+            yield separator + ', '.join(batch)
+            separator = ', '
+            batch = []
+    if batch:
+        yield separator + ', '.join(batch)
+
+
+def stream_document(document_id, user_id, show_predictions=False):
+    """
+    Generates the JSON of load_document in chunks. Denotations and relations are encoded
+    while they are read from the cursor, so they are never held in memory all at once.
+    """
+    cursor = get_connection().cursor()
+    yield '{"sourceid": %s, "text": %s, "denotations": [' % (json.dumps(document_id),
+                                                             json.dumps(get_text(cursor, document_id)))
+    user_info = {}
+    annotation_id_map = {}
+    query_denotations(cursor, document_id, user_id, show_predictions)
+    for chunk in encode_items(iterate_denotations(iterate_rows(cursor), user_id, show_predictions,
+                                                  user_info, annotation_id_map)):
+        yield chunk
+    yield '], "relations": ['
+    query_relations(cursor, document_id, user_id, show_predictions)
+    for chunk in encode_items(iterate_relations(iterate_rows(cursor), annotation_id_map)):
+        yield chunk
+    cursor.close()
+    yield '], "config": %s}' % json.dumps({'entity types': get_entity_types(document_id),
+                                          'relation types': get_relation_types(document_id),
+                                          'users': user_info})
 
 
 def get_associated_users(document_id):
     cursor = get_connection().cursor()
-    cursor.execute("SELECT DISTINCT ud.user_id "
-                   "FROM LTN_DEVELOP.USER_DOCUMENTS ud "
-                   "JOIN LTN_DEVELOP.DOCUMENTS d ON ud.document_id = d.id")
-    users = map(lambda row: row[0], cursor.fetchall())
+    users = fetch_associated_users(cursor, document_id)
     cursor.close()
     return users
 
 
+def fetch_associated_users(cursor, document_id):
+    cursor.execute("SELECT DISTINCT USER_ID FROM LTN_DEVELOP.USER_DOCUMENTS WHERE DOCUMENT_ID = ? ORDER BY USER_ID",
+                   (document_id,))
+    return map(lambda row: row[0], cursor.fetchall())
+
+
+def load_user_annotations(document_id, user_ids=None, timings=None):
+    """
+    Loads the annotations each user made on the document, regardless of their visibility, with one query
+    for all users. For every user the result is shaped like load_document as seen by that user, restricted
+    to the own denotations and relations. Without user_ids, all users with a user document are loaded.
+    """
+    queries = {'text': lambda cursor: get_text(cursor, document_id),
+               'denotations': lambda cursor: fetch_annotations_of_users(cursor, ANNOTATIONS_OF_USERS,
+                                                                        document_id, user_ids),
+               'relations': lambda cursor: fetch_annotations_of_users(cursor, RELATIONS_OF_USERS,
+                                                                      document_id, user_ids)}
+    if user_ids is None:
+        queries['users'] = lambda cursor: fetch_associated_users(cursor, document_id)
+    parts = run_queries(queries, timings)
+    denotation_rows = group_by_user(parts['denotations'], 1)
+    relation_rows = group_by_user(parts['relations'], 8)
+    documents = []
+    for user_id in user_ids if user_ids is not None else parts['users']:
+        denotations, users, annotation_id_map = get_denotations_and_users(denotation_rows.get(str(user_id), []),
+                                                                          user_id, False)
+        documents.append({'sourceid': document_id,
+                          'text': parts['text'],
+                          'denotations': denotations,
+                          'relations': get_relations(relation_rows.get(str(user_id), []), annotation_id_map),
+                          'user_id': user_id})
+    return documents
+
+
+ANNOTATIONS_OF_USERS = 'SELECT E.ID, UD.USER_ID, O."START", O."END", T.CODE, TT."LABEL", T.GROUP_ID, ' \
+                       'T."GROUP", E."LABEL", U."NAME", TT.ID ' \
+                       'FROM LTN_DEVELOP.ENTITIES E ' \
+                       'JOIN LTN_DEVELOP.USER_DOCUMENTS UD ON E.USER_DOC_ID = UD.ID AND UD.DOCUMENT_ID = ? ' \
+                       'JOIN LTN_DEVELOP.OFFSETS O ON O.ENTITY_ID = E.ID AND O.USER_DOC_ID = E.USER_DOC_ID ' \
+                       'LEFT OUTER JOIN LTN_DEVELOP.USERS U ON UD.USER_ID = U.ID ' \
+                       'LEFT OUTER JOIN LTN_DEVELOP.TASK_TYPES TT ON E.TYPE_ID = TT.ID ' \
+                       'LEFT OUTER JOIN LTN_DEVELOP.TYPES T ON TT.TYPE_ID = T.ID ' \
+                       '%s ' \
+                       'ORDER BY UD.USER_ID, E.ID'
+
+# pairs, like their entities, always belong to a single user document
+RELATIONS_OF_USERS = 'SELECT P.ID, P.E1_ID, P.E2_ID, P.LABEL, T.CODE, TT.LABEL, ' \
+                     'T.GROUP_ID, T."GROUP", UD.USER_ID, TT.ID ' \
+                     'FROM LTN_DEVELOP.PAIRS P ' \
+                     'LEFT OUTER JOIN LTN_DEVELOP.TASK_TYPES TT ON P.TYPE_ID = TT.ID ' \
+                     'JOIN LTN_DEVELOP.TYPES T ON TT.TYPE_ID = T.ID ' \
+                     'JOIN LTN_DEVELOP.ENTITIES E1 ON P.E1_ID = E1.ID AND P.DDI = 1 ' \
+                     'AND P.USER_DOC_ID = E1.USER_DOC_ID ' \
+                     'JOIN LTN_DEVELOP.ENTITIES E2 ON P.E2_ID = E2.ID AND P.DDI = 1 ' \
+                     'AND P.USER_DOC_ID = E2.USER_DOC_ID ' \
+                     'JOIN LTN_DEVELOP.USER_DOCUMENTS UD ON P.USER_DOC_ID = UD.ID AND UD.DOCUMENT_ID = ? ' \
+                     '%s'
+
+
+def fetch_annotations_of_users(cursor, sql, document_id, user_ids):
+    if user_ids is None:
+        cursor.execute(sql % '', (document_id,))
+    else:
+        cursor.execute(sql % ('WHERE UD.USER_ID IN (%s)' % placeholders(user_ids)), (document_id,) + tuple(user_ids))
+    return cursor.fetchall()
+
+
+def group_by_user(rows, column):
+    grouped = {}
+    for row in rows:
+        grouped.setdefault(str(row[column]), []).append(row)
+    return grouped
+
+
 def delete_user_document(user_document_id):
     return delete_user_documents([user_document_id])
 
 
 def delete_user_documents(user_document_ids):
     user_document_ids = "('" + "', '".join(user_document_ids) + "')"
-    try:
-        cursor = get_connection().cursor()
+    with transaction() as connection:
+        cursor = connection.cursor()
         cursor.execute("DELETE FROM LTN_DEVELOP.PAIRS WHERE USER_DOC_ID IN " + user_document_ids)
         cursor.execute("DELETE FROM LTN_DEVELOP.OFFSETS WHERE USER_DOC_ID IN  " + user_document_ids)
         cursor.execute("DELETE FROM LTN_DEVELOP.ENTITIES WHERE USER_DOC_ID IN " + user_document_ids)
         cursor.execute("DELETE FROM LTN_DEVELOP.USER_DOCUMENTS WHERE ID IN " + user_document_ids)
-        get_connection().commit()
-        return True
-    except Exception, e:
-        raise e
+        cursor.close()
+    return True
 
 
 def delete_document(document_id):
-    try:
-        cursor = get_connection().cursor()
+    with transaction() as connection:
+        cursor = connection.cursor()
         cursor.execute("SELECT ID FROM LTN_DEVELOP.USER_DOCUMENTS WHERE DOCUMENT_ID = ?", (document_id,))
         user_document_ids = map(lambda t: t[0], cursor.fetchall())
         delete_user_documents(user_document_ids)
 
         sql_to_prepare = 'CALL LTN_DEVELOP.delete_document (?)'
         params = {'DOCUMENT_ID': document_id}
-        psid = cursor.prepare(sql_to_prepare)
-        ps = cursor.get_prepared_statement(psid)
-        cursor.execute_prepared(ps, [params])
-        get_connection().commit()
-
-        return True
-    except Exception, e:
-        raise e
+        execute_prepared(cursor, sql_to_prepare, params)
+        cursor.close()
+    document_texts.invalidate(document_id)
+    document_tasks.invalidate(document_id)
+    return True
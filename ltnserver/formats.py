@@ -1,28 +1,26 @@
 import StringIO
+from collections import Counter
 from datetime import datetime
 
 import bioc
-from flask import request, Response
+from flask import request, Response, stream_with_context
 from flask_login import current_user
-from metapub import PubMedFetcher
-from metapub.exceptions import InvalidPMID
 
-from ltnserver import app, get_connection, respond_with
-from ltnserver.documents import create_new_user_doc_id, save_document, load_user_doc_id, load_document, \
-    get_associated_users
-from ltnserver.types import get_task_types
+from ltnserver import app, respond_with, execute_prepared, transaction, get_connection
+from ltnserver.biocxml import collection_chunks, zip_chunks, iterate_documents
+from ltnserver.documents import create_new_user_doc_id, save_document, load_user_doc_id, load_user_annotations, \
+    get_submitted_annotations, convert_relations, get_id_map, chunks, placeholders, MAX_BATCH_SIZE, \
+    tracks_annotations, count_spans, update_tagger
+from ltnserver.settings import get_settings
+from ltnserver.training import model_training_queue
+from ltnserver.types import get_type_catalogue
 
 TYPE_PLAINTEXT = 'plaintext'
 TYPE_BIOC = 'bioc'
+BIOC_MIMETYPES = ['application/xml', 'text/xml']
+BULK_CHUNK_SIZE = 5000
 
-
-@app.route('/pubmed/<pubmed_id>')
-def fetch_pubmed_abstract(pubmed_id):
-    try:
-        article = PubMedFetcher(cachedir=".cache/").article_by_pmid(pubmed_id)
-        return respond_with(article.abstract)
-    except InvalidPMID:
-        return 'Invalid PubmedID', 500
+import_settings = get_settings('import') or {}
 
 
 @app.route('/import', methods=['POST'])
@@ -31,85 +29,197 @@ def import_document():
     if user_id is None:
         return "No user is logged in", 401
 
-    req = request.get_json()
-    doc_type = req.get('type', TYPE_PLAINTEXT)
-    task = req['task']
-
-    documents = []
-    if doc_type == TYPE_PLAINTEXT:
-        documents.append(req)
-    elif doc_type == TYPE_BIOC:
-        documents = extract_documents_from_bioc(req['text'], req['document_id'], task)
+    if request.mimetype in BIOC_MIMETYPES or (request.mimetype == 'multipart/form-data' and 'file' in request.files):
+        # BioC collections can be uploaded as they are, they are then parsed while they are received
+        doc_type = TYPE_BIOC
+        task = request.args.get('task', type=int)
+        if task is None or not task_exists(task):
+            return "The task query argument must be the id of an existing task.", 400
+        id_prefix = request.args['document_id']
+        visibility = request.args.get('visibility', 1)
+        run_as_job = request.args.get('async') in ['true', '1']
+        stream = request.files['file'].stream if 'file' in request.files else request.stream
     else:
-        return "Document type not supported", 400
-
-    for document in documents:
-        document_id = document['document_id']
-        message, code = create_document_in_database(document_id,
-                                                    document['text'],
-                                                    int(document.get('visibility', 1)),
-                                                    task)
+        req = request.get_json()
+        doc_type = req.get('type', TYPE_PLAINTEXT)
+        task = req['task']
+        id_prefix = req.get('document_id')
+        visibility = 1
+        run_as_job = bool(req.get('async', False))
+        if doc_type == TYPE_PLAINTEXT:
+            return write_document(req, doc_type, task, user_id)
+        elif doc_type == TYPE_BIOC:
+            stream = StringIO.StringIO(req['text'].encode('utf-8'))
+        else:
+            return "Document type not supported", 400
+
+    if run_as_job:
+        from ltnserver.imports import start_import_job
+        job = start_import_job(stream, id_prefix, task, user_id, visibility)
+        return respond_with({'job_id': job.id}), 202
+
+    # documents are written in batches while the collection is read
+    imported = 0
+    skipped = []
+    try:
+        for batch in batches(iterate_documents_from_bioc(stream, id_prefix, task, visibility),
+                             import_settings.get('batch_size', 50)):
+            imported_ids, skipped_ids = import_documents_in_bulk(batch, task, user_id)
+            imported += len(imported_ids)
+            skipped.extend(skipped_ids)
+    except SyntaxError, e:
+        print e
+        return "Invalid BioC collection after %d imported documents: %s" % (imported, e), 400
+
+    if skipped:
+        return "Documents with the IDs %s already exist, %d other documents were imported" % \
+            (', '.join("'%s'" % document_id for document_id in skipped), imported), 409
+    return "Successfully imported", 201
+
+
+def write_document(document, doc_type, task, user_id):
+    document_id = document['document_id']
+    visibility = int(document.get('visibility', 1))
+    # every document is imported together with its annotations, or not at all
+    with transaction():
+        message, code = create_document_in_database(document_id, document['text'], visibility, task, user_id)
         if code == 201 and doc_type == TYPE_BIOC:
             save_document(document,
                           load_user_doc_id(document_id, user_id),
                           document_id,
                           user_id,
-                          int(document.get('visibility', 1)))
-        if code != 201:
-            return message, code
+                          task,
+                          bool(visibility))
+    return message, code
 
-    return "Successfully imported", 201
+
+def import_documents_in_bulk(documents, task, user_id):
+    """
+    Imports new documents together with their annotations in one transaction: their existence is checked
+    with one query and the user documents, entities, offsets and pairs are inserted with chunked executemany.
+    Documents whose id already exists are skipped. Returns the ids of the imported and the skipped documents.
+    """
+    existing = set()
+    new_documents = []
+    skipped = []
+    with transaction() as connection:
+        cursor = connection.cursor()
+        document_ids = [document['document_id'] for document in documents]
+        for chunk in chunks(document_ids, MAX_BATCH_SIZE):
+            cursor.execute('SELECT ID FROM LTN_DEVELOP.DOCUMENTS WHERE ID IN (%s)' % placeholders(chunk), chunk)
+            existing.update(row[0] for row in cursor.fetchall())
+        now = datetime.now()
+        user_documents, entities, offsets, pairs = [], [], [], []
+        tracked = tracks_annotations()
+        annotated = []
+        for document in documents:
+            document_id = document['document_id']
+            if document_id in existing:
+                skipped.append(document_id)
+                continue
+            existing.add(document_id)
+            new_documents.append(document)
+            # the procedure stays one call per document, it may do more than inserting the text
+            execute_prepared(cursor, 'CALL LTN_DEVELOP.add_document (?, ?, ?)',
+                             {'DOCUMENT_ID': document_id,
+                              'DOCUMENT_TEXT': document['text'].replace("'", "''"),
+                              'TASK': task})
+            user_doc_id = create_new_user_doc_id(user_id, document_id)
+            user_documents.append((user_doc_id, user_id, document_id, int(document.get('visibility', 1)), now, now))
+            document_entities, document_offsets = get_submitted_annotations(user_doc_id, document['denotations'])
+            entities.extend(document_entities.values())
+            for entity_offsets in document_offsets.values():
+                offsets.extend(entity_offsets)
+            if tracked:
+                annotated.append((document_id, document['text'], count_spans(document_entities, document_offsets)))
+            pairs.extend(convert_relations(user_doc_id, document['relations'], get_id_map(document['denotations'])))
+        executemany_in_chunks(cursor, "INSERT INTO LTN_DEVELOP.USER_DOCUMENTS VALUES (?, ?, ?, ?, ?, ?)",
+                              user_documents)
+        executemany_in_chunks(cursor, "INSERT INTO LTN_DEVELOP.ENTITIES (ID, USER_DOC_ID, TYPE_ID, LABEL) "
+                                      "VALUES (?, ?, ?, ?)", entities)
+        executemany_in_chunks(cursor, "INSERT INTO LTN_DEVELOP.OFFSETS VALUES (?, ?, ?, ?)", offsets)
+        executemany_in_chunks(cursor, "INSERT INTO LTN_DEVELOP.PAIRS (E1_ID, E2_ID, USER_DOC_ID, DDI, TYPE_ID, LABEL) "
+                                      "VALUES (?, ?, ?, ?, ?, ?)", pairs)
+        cursor.close()
+    print "Imported %d documents in bulk, skipped %d" % (len(new_documents), len(skipped))
+    if new_documents:
+        model_training_queue.add(task)
+    for document_id, text, spans in annotated:
+        update_tagger(task, document_id, user_id, Counter(), spans, text)
+    return [document['document_id'] for document in new_documents], skipped
+
+
+def executemany_in_chunks(cursor, sql, rows):
+    for chunk in chunks(rows, BULK_CHUNK_SIZE):
+        cursor.executemany(sql, chunk)
+
+
+def batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
 def extract_documents_from_bioc(bioc_text, id_prefix, task):
-    string_doc = StringIO.StringIO(bioc_text.encode('utf-8'))
-    bioc_collection = bioc.parse(string_doc)
-    documents = []
-    for bioc_doc in bioc_collection.documents:
-        doc_text = ''
-        passage_count = 0
-        denotations = []
-        relations = []
-        for passage in bioc_doc.passages:
-            if passage.infons.get('type') != 'title':
-                if len(passage.text) > 0:
-                    doc_text += passage.text
-                    prefix = 'p' + str(passage_count)
-                    passage_count += 1
-                    passage_denotations = extract_denotations_from_bioc_object(passage, task, prefix)
-                    denotations_map = dict(map(lambda d: (d['id'][len(prefix):], d['id']), passage_denotations))
-                    passage_relations = extract_relations_from_bioc_object(passage, task, prefix, denotations_map)
-                    denotations.extend(passage_denotations)
-                    relations.extend(passage_relations)
+    return list(iterate_documents_from_bioc(StringIO.StringIO(bioc_text.encode('utf-8')), id_prefix, task))
+
+
+def iterate_documents_from_bioc(stream, id_prefix, task, visibility=1):
+    for bioc_doc in iterate_documents(stream):
+        document = convert_bioc_document(bioc_doc, id_prefix, task)
+        document['visibility'] = visibility
+        yield document
+
+
+def convert_bioc_document(bioc_doc, id_prefix, task, catalogue=None):
+    doc_text = ''
+    passage_count = 0
+    denotations = []
+    relations = []
+    for passage in bioc_doc.passages:
+        if passage.infons.get('type') != 'title':
+            if len(passage.text) > 0:
+                doc_text += passage.text
+                prefix = 'p' + str(passage_count)
+                passage_count += 1
+                passage_denotations = extract_denotations_from_bioc_object(passage, task, prefix, catalogue)
+                denotations_map = dict(map(lambda d: (d['id'][len(prefix):], d['id']), passage_denotations))
+                passage_relations = extract_relations_from_bioc_object(passage, task, prefix, denotations_map,
+                                                                       catalogue)
+                denotations.extend(passage_denotations)
+                relations.extend(passage_relations)
+            else:
+                sentence_count = 0
+                if passage.sentences is not None:
+                    sentences = passage.sentences
                 else:
-                    sentence_count = 0
-                    if passage.sentences is not None:
-                        sentences = passage.sentences
-                    else:
-                        sentences = passage
-                    for sentence in sentences:
-                        doc_text += sentence.text
-                        prefix = 's' + str(sentence_count)
-                        sentence_count += 1
-                        sentence_denotations = extract_denotations_from_bioc_object(passage, task, prefix)
-                        denotations_map = dict(map(lambda d: (d['id'][len(prefix):], d['id']), sentence_denotations))
-                        sentence_relations = extract_relations_from_bioc_object(passage, task, prefix, denotations_map)
-                        denotations.extend(sentence_denotations)
-                        relations.extend(sentence_relations)
-        document = {
-            'document_id': id_prefix + '__' + bioc_doc.id,
-            'text': doc_text,
-            'denotations': denotations,
-            'relations': relations,
-        }
-        documents.append(document)
-    string_doc.close()
-    return documents
+                    sentences = passage
+                for sentence in sentences:
+                    doc_text += sentence.text
+                    prefix = 's' + str(sentence_count)
+                    sentence_count += 1
+                    sentence_denotations = extract_denotations_from_bioc_object(passage, task, prefix, catalogue)
+                    denotations_map = dict(map(lambda d: (d['id'][len(prefix):], d['id']), sentence_denotations))
+                    sentence_relations = extract_relations_from_bioc_object(passage, task, prefix, denotations_map,
+                                                                            catalogue)
+                    denotations.extend(sentence_denotations)
+                    relations.extend(sentence_relations)
+    return {
+        'document_id': id_prefix + '__' + bioc_doc.id,
+        'text': doc_text,
+        'denotations': denotations,
+        'relations': relations,
+    }
 
 
-def extract_denotations_from_bioc_object(bioc_object, task, id_prefix):
+def extract_denotations_from_bioc_object(bioc_object, task, id_prefix, catalogue=None):
     denotations = []
-    known_types = dict((t['code'], t) for t in get_task_types(task, relation=False))
+    known_types = (catalogue or get_type_catalogue(task)).by_code[False]
     for annotation in bioc_object.annotations:
         denotation = {'id': id_prefix + annotation.id, 'span': {}}
         denotation['span']['begin'] = annotation.locations[0].offset
@@ -131,9 +241,9 @@ def extract_denotations_from_bioc_object(bioc_object, task, id_prefix):
     return denotations
 
 
-def extract_relations_from_bioc_object(bioc_object, task, id_prefix, denotations):
+def extract_relations_from_bioc_object(bioc_object, task, id_prefix, denotations, catalogue=None):
     relations = []
-    known_types = dict((t['code'], t) for t in get_task_types(task, relation=True))
+    known_types = (catalogue or get_type_catalogue(task)).by_code[True]
     for b_relation in bioc_object.relations:
         nodes = list(b_relation.nodes)
         subj_id = denotations.get(nodes[0].refid, None)
@@ -160,28 +270,26 @@ def extract_relations_from_bioc_object(bioc_object, task, id_prefix, denotations
     return relations
 
 
-def create_document_in_database(document_id, document_text, document_visibility, task):
-    cursor = get_connection().cursor()
-    cursor.execute("SELECT COUNT(*) FROM LTN_DEVELOP.DOCUMENTS WHERE ID = ?", (document_id,))
-    result = cursor.fetchone()
-    if result[0] != 0:
-        return "A document with the ID '%s' already exists" % (document_id,), 409
-
-    sql_to_prepare = 'CALL LTN_DEVELOP.add_document (?, ?, ?)'
-    params = {
-        'DOCUMENT_ID': document_id,
-        'DOCUMENT_TEXT': document_text.replace("'", "''"),
-        'TASK': task
-    }
-    psid = cursor.prepare(sql_to_prepare)
-    ps = cursor.get_prepared_statement(psid)
-    cursor.execute_prepared(ps, [params])
-    get_connection().commit()
-
-    cursor.execute("INSERT INTO LTN_DEVELOP.USER_DOCUMENTS VALUES (?, ?, ?, ?, ?, ?)",
-                   (create_new_user_doc_id(current_user.get_id(), document_id), current_user.get_id(), document_id,
-                    document_visibility, datetime.now(), datetime.now()))
-    get_connection().commit()
+def create_document_in_database(document_id, document_text, document_visibility, task, user_id):
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT COUNT(*) FROM LTN_DEVELOP.DOCUMENTS WHERE ID = ?", (document_id,))
+        result = cursor.fetchone()
+        if result[0] != 0:
+            return "A document with the ID '%s' already exists" % (document_id,), 409
+
+        sql_to_prepare = 'CALL LTN_DEVELOP.add_document (?, ?, ?)'
+        params = {
+            'DOCUMENT_ID': document_id,
+            'DOCUMENT_TEXT': document_text.replace("'", "''"),
+            'TASK': task
+        }
+        execute_prepared(cursor, sql_to_prepare, params)
+
+        cursor.execute("INSERT INTO LTN_DEVELOP.USER_DOCUMENTS VALUES (?, ?, ?, ?, ?, ?)",
+                       (create_new_user_doc_id(user_id, document_id), user_id, document_id,
+                        document_visibility, datetime.now(), datetime.now()))
+        cursor.close()
     return "Successfully imported", 201
 
 
@@ -228,19 +336,56 @@ def create_bioc_document_from_document_json(document):
 def export(document_id):
     user_id = request.args.get('user_id', None)
     if user_id is None:
-        user_ids_to_export = get_associated_users(document_id)
+        user_ids_to_export = None
     else:
         user_ids_to_export = [user_id]
     return export_document(document_id, user_ids_to_export)
 
 
-def export_document(document_id, users):
+def export_document(document_id, users=None):
     bcollection = bioc.BioCCollection()
-    for user_id in users:
-        document = load_document(document_id, user_id)
+    for document in load_user_annotations(document_id, users):
         bdocument = create_bioc_document_from_document_json(document)
         bcollection.add_document(bdocument)
     result = bcollection.tobioc()
     response = Response(result, mimetype='text/xml')
     response.headers["Content-Disposition"] = "attachment; filename=" + document_id + ".xml"
     return response
+
+
+@app.route('/tasks/<task_id>/export', methods=['GET'])
+def export_task(task_id):
+    document_ids = get_task_document_ids(task_id)
+    # the request context keeps the connection until the whole export is sent
+    if request.args.get('format') == 'zip':
+        files = (('%s.xml' % document_id, collection_chunks(bioc_documents_of(document_id)))
+                 for document_id in document_ids)
+        response = Response(stream_with_context(zip_chunks(files)), mimetype='application/zip')
+        response.headers["Content-Disposition"] = "attachment; filename=task_%s.zip" % task_id
+    else:
+        documents = (bioc_document for document_id in document_ids
+                     for bioc_document in bioc_documents_of(document_id))
+        response = Response(stream_with_context(collection_chunks(documents)), mimetype='text/xml')
+        response.headers["Content-Disposition"] = "attachment; filename=task_%s.xml" % task_id
+    return response
+
+
+def task_exists(task_id):
+    cursor = get_connection().cursor()
+    cursor.execute('SELECT 1 FROM LTN_DEVELOP.TASKS WHERE ID = ?', (task_id,))
+    result = cursor.fetchone()
+    cursor.close()
+    return result is not None
+
+
+def get_task_document_ids(task_id):
+    cursor = get_connection().cursor()
+    cursor.execute('SELECT ID FROM LTN_DEVELOP.DOCUMENTS WHERE TASK = ? ORDER BY ID', (task_id,))
+    document_ids = map(lambda row: row[0], cursor.fetchall())
+    cursor.close()
+    return document_ids
+
+
+def bioc_documents_of(document_id):
+    for document in load_user_annotations(document_id):
+        yield create_bioc_document_from_document_json(document)
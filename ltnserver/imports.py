@@ -0,0 +1,224 @@
+import shutil
+import tempfile
+import time
+import uuid
+
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
+from threading import Thread, Lock
+from xml.etree import cElementTree
+
+from flask_login import current_user
+
+from ltnserver import app, respond_with, pooled_connection
+from ltnserver.biocxml import iterate_document_elements, read_document_xml
+from ltnserver.formats import convert_bioc_document, write_document, import_documents_in_bulk, import_settings, \
+    batches, TYPE_BIOC
+from ltnserver.types import get_type_catalogue
+
+MAX_JOBS = 100
+MAX_ERRORS = 1000
+
+jobs = OrderedDict()
+jobs_lock = Lock()
+parse_workers = None
+
+
+class ImportJob:
+    """Progress of an import that runs in the background."""
+
+    def __init__(self, user_id, task):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.task = task
+        self.state = 'queued'
+        self.message = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.parsed = 0
+        self.imported = 0
+        self.skipped = 0
+        self.failed = 0
+        self.errors = []
+        self.lock = Lock()
+
+    def start(self):
+        with self.lock:
+            self.state = 'running'
+            self.started_at = time.time()
+
+    def finish(self, state, message=None):
+        with self.lock:
+            self.state = state
+            self.message = message
+            self.finished_at = time.time()
+
+    def record_parsed(self, count):
+        with self.lock:
+            self.parsed += count
+
+    def record(self, document_id, code, message=None):
+        with self.lock:
+            if code == 201:
+                self.imported += 1
+                return
+            if code == 409:
+                self.skipped += 1
+            else:
+                self.failed += 1
+            if len(self.errors) < MAX_ERRORS:
+                self.errors.append({'document_id': document_id, 'status': code, 'message': message})
+
+    def is_done(self):
+        return self.state in ['finished', 'failed']
+
+    def to_dict(self):
+        with self.lock:
+            elapsed = (self.finished_at or time.time()) - self.started_at if self.started_at else 0.0
+            return {'id': self.id,
+                    'task': self.task,
+                    'state': self.state,
+                    'message': self.message,
+                    'parsed': self.parsed,
+                    'imported': self.imported,
+                    'skipped': self.skipped,
+                    'failed': self.failed,
+                    'errors': list(self.errors),
+                    'elapsed_s': elapsed,
+                    'documents_per_second': self.imported / elapsed if elapsed else 0.0}
+
+
+@app.route('/import/jobs')
+def get_import_jobs():
+    user_id = current_user.get_id()
+    with jobs_lock:
+        user_jobs = [job for job in jobs.itervalues() if job.user_id == user_id]
+    return respond_with([job.to_dict() for job in user_jobs])
+
+
+@app.route('/import/jobs/<job_id>')
+def get_import_job(job_id):
+    with jobs_lock:
+        job = jobs.get(job_id)
+    if job is None or job.user_id != current_user.get_id():
+        return 'Unknown import job.', 404
+    return respond_with(job.to_dict())
+
+
+def start_import_job(stream, id_prefix, task, user_id, visibility=1):
+    """Starts importing a BioC collection in the background and returns the job tracking its progress."""
+    # the upload has to outlive the request, it is kept in memory up to spool_bytes
+    upload = tempfile.SpooledTemporaryFile(max_size=import_settings.get('spool_bytes', 16 * 1024 * 1024))
+    shutil.copyfileobj(stream, upload)
+    upload.seek(0)
+    catalogue = get_type_catalogue(task)
+    job = ImportJob(user_id, task)
+    with jobs_lock:
+        jobs[job.id] = job
+        forget_finished_jobs()
+    thread = Thread(target=run_import_job, args=(job, upload, id_prefix, task, visibility, catalogue))
+    thread.daemon = True
+    thread.start()
+    return job
+
+
+def forget_finished_jobs():
+    for job_id in [job.id for job in jobs.itervalues() if job.is_done()][:max(0, len(jobs) - MAX_JOBS)]:
+        del jobs[job_id]
+
+
+def init_parse_workers():
+    """
+    Forks the parse workers. Forking is only safe before the server holds database connections
+    or runs other threads, so this happens at startup and never on demand.
+    """
+    global parse_workers
+    processes = import_settings.get('parse_workers', cpu_count())
+    if parse_workers is None and processes > 0:
+        parse_workers = Pool(processes)
+
+
+class Converted:
+    """Result of converting a batch in the importing thread, for when there are no parse workers."""
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    def get(self):
+        return self.documents
+
+
+def convert_document(arguments):
+    """Runs in the parse workers, so it must not access the database."""
+    document_id, xml, id_prefix, task, catalogue = arguments
+    try:
+        return document_id, convert_bioc_document(read_document_xml(xml), id_prefix, task, catalogue), None
+    except Exception, e:
+        return document_id, None, str(e)
+
+
+def iterate_batches(upload, id_prefix, task, catalogue, batch_size):
+    return batches(((id_prefix + '__' + element.findtext('id', ''), cElementTree.tostring(element),
+                     id_prefix, task, catalogue) for element in iterate_document_elements(upload)), batch_size)
+
+
+def run_import_job(job, upload, id_prefix, task, visibility, catalogue):
+    """
+    Parses the upload in this thread, converts batches of documents in the parse workers and writes
+    each converted batch while the next one is being converted.
+    """
+    job.start()
+    try:
+        workers = parse_workers
+        pending = None
+        for batch in iterate_batches(upload, id_prefix, task, catalogue, import_settings.get('batch_size', 50)):
+            job.record_parsed(len(batch))
+            if workers is not None:
+                converting = workers.map_async(convert_document, batch)
+            else:
+                converting = Converted(map(convert_document, batch))
+            if pending is not None:
+                write_batch(job, pending.get(), task, visibility)
+            pending = converting
+        if pending is not None:
+            write_batch(job, pending.get(), task, visibility)
+        job.finish('finished')
+    except Exception, e:
+        print 'Import job %s failed: ' % job.id, e
+        job.finish('failed', str(e))
+    finally:
+        upload.close()
+
+
+def write_batch(job, converted, task, visibility):
+    documents = []
+    for document_id, document, error in converted:
+        if document is None:
+            job.record(document_id, 400, error)
+        else:
+            document['visibility'] = visibility
+            documents.append(document)
+    try:
+        with pooled_connection():
+            imported, skipped = import_documents_in_bulk(documents, task, job.user_id)
+    except Exception, e:
+        print 'Bulk import failed, importing the documents one by one: ', e
+        write_one_by_one(job, documents, task)
+        return
+    for document_id in imported:
+        job.record(document_id, 201)
+    for document_id in skipped:
+        job.record(document_id, 409, "A document with the ID '%s' already exists" % (document_id,))
+
+
+def write_one_by_one(job, documents, task):
+    """Finds the documents that made a batch fail."""
+    with pooled_connection():
+        for document in documents:
+            try:
+                message, code = write_document(document, TYPE_BIOC, task, job.user_id)
+            except Exception, e:
+                print e
+                message, code = str(e), 500
+            job.record(document['document_id'], code, message)
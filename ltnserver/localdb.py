@@ -0,0 +1,304 @@
+"""
+Local SQLite stand-in for the LTN_DEVELOP schema on SAP HANA.
+
+The connection and cursor objects mimic the subset of the pyhdb interface used by the server
+(including prepared procedure calls), and the stored procedures are emulated in Python.
+Every round trip to the "database" can be slowed down artificially to model network latency.
+"""
+import os
+import re
+import sqlite3
+import tempfile
+import time
+
+from collections import Counter
+from threading import Lock
+
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS LTN_DEVELOP.USERS ('
+    'ID NVARCHAR(255) PRIMARY KEY, NAME NVARCHAR(255), TOKEN NVARCHAR(255), DESCRIPTION NVARCHAR(255), IMAGE BLOB)',
+    'CREATE TABLE IF NOT EXISTS LTN_DEVELOP.TASKS ('
+    'ID INTEGER PRIMARY KEY AUTOINCREMENT, NAME NVARCHAR(255), DOMAIN NVARCHAR(255), CONFIG NVARCHAR(255), '
+    'AUTHOR NVARCHAR(255))',
+    'CREATE TABLE IF NOT EXISTS LTN_DEVELOP.DOCUMENTS ('
+    'ID NVARCHAR(255) PRIMARY KEY, TEXT NCLOB, TASK INTEGER)',
+    'CREATE TABLE IF NOT EXISTS LTN_DEVELOP.USER_DOCUMENTS ('
+    'ID NVARCHAR(255) PRIMARY KEY, USER_ID NVARCHAR(255), DOCUMENT_ID NVARCHAR(255), VISIBILITY INTEGER, '
+    'CREATED_AT TIMESTAMP, UPDATED_AT TIMESTAMP)',
+    'CREATE TABLE IF NOT EXISTS LTN_DEVELOP.TYPES ('
+    'ID INTEGER PRIMARY KEY AUTOINCREMENT, CODE NVARCHAR(255), NAME NVARCHAR(255), GROUP_ID NVARCHAR(255), '
+    '"GROUP" NVARCHAR(255))',
+    'CREATE TABLE IF NOT EXISTS LTN_DEVELOP.TASK_TYPES ('
+    'ID INTEGER PRIMARY KEY AUTOINCREMENT, LABEL NVARCHAR(255), TASK_ID INTEGER, TYPE_ID INTEGER, '
+    'RELATION INTEGER)',
+    'CREATE TABLE IF NOT EXISTS LTN_DEVELOP.MODEL_VERSIONS (TASK_ID INTEGER PRIMARY KEY, VERSION INTEGER)',
+    'CREATE TABLE IF NOT EXISTS LTN_DEVELOP.ENTITIES ('
+    'ID NVARCHAR(255), USER_DOC_ID NVARCHAR(255), TYPE_ID INTEGER, LABEL NVARCHAR(255), TEXT NVARCHAR(255), '
+    'PRIMARY KEY (ID, USER_DOC_ID))',
+    'CREATE TABLE IF NOT EXISTS LTN_DEVELOP.OFFSETS ('
+    '"START" INTEGER, "END" INTEGER, ENTITY_ID NVARCHAR(255), USER_DOC_ID NVARCHAR(255))',
+    'CREATE TABLE IF NOT EXISTS LTN_DEVELOP.PAIRS ('
+    'ID INTEGER PRIMARY KEY AUTOINCREMENT, E1_ID NVARCHAR(255), E2_ID NVARCHAR(255), USER_DOC_ID NVARCHAR(255), '
+    'DDI INTEGER, TYPE_ID INTEGER, LABEL NVARCHAR(255))',
+    'CREATE INDEX IF NOT EXISTS LTN_DEVELOP.USER_DOCUMENTS_DOCUMENT ON USER_DOCUMENTS (DOCUMENT_ID)',
+    'CREATE INDEX IF NOT EXISTS LTN_DEVELOP.ENTITIES_USER_DOC ON ENTITIES (USER_DOC_ID)',
+    'CREATE INDEX IF NOT EXISTS LTN_DEVELOP.OFFSETS_USER_DOC ON OFFSETS (USER_DOC_ID, ENTITY_ID)',
+    'CREATE INDEX IF NOT EXISTS LTN_DEVELOP.PAIRS_USER_DOC ON PAIRS (USER_DOC_ID)',
+]
+
+TEXT_ANALYSIS_TABLES = ['$TA_INDEX_', '$TA_ER_INDEX_']
+
+round_trips = 0
+round_trip_lock = Lock()
+
+
+class Lob:
+
+    def __init__(self, value):
+        self.value = value
+
+    def read(self):
+        return self.value
+
+
+sqlite3.register_converter('NCLOB', lambda value: Lob(value.decode('utf-8')))
+sqlite3.register_converter('BLOB', Lob)
+
+
+def count_round_trip():
+    global round_trips
+    with round_trip_lock:
+        round_trips += 1
+
+
+def get_round_trips():
+    return round_trips
+
+
+def reset_round_trips():
+    global round_trips
+    with round_trip_lock:
+        round_trips = 0
+
+
+def connect(settings):
+    path = settings.get('path') or os.path.join(tempfile.gettempdir(), 'ltn_develop.sqlite')
+    return LocalConnection(path, float(settings.get('latency', 0.0)))
+
+
+class LocalConnection:
+
+    def __init__(self, path, latency=0.0):
+        self.latency = latency
+        self.db = sqlite3.connect(':memory:', timeout=30, check_same_thread=False,
+                                  detect_types=sqlite3.PARSE_DECLTYPES)
+        self.db.execute('ATTACH DATABASE ? AS LTN_DEVELOP', (path,))
+        self.db.execute('CREATE TABLE DUMMY (DUMMY NVARCHAR(1))')
+        self.db.execute("INSERT INTO DUMMY VALUES ('X')")
+        for statement in SCHEMA:
+            self.db.execute(statement)
+        self.db.commit()
+        self.closed = False
+        # like HANA, prepared statements belong to the session and not to the cursor preparing them
+        self.prepared_statements = {}
+
+    def round_trip(self):
+        count_round_trip()
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def cursor(self):
+        return LocalCursor(self)
+
+    def commit(self):
+        self.round_trip()
+        self.db.commit()
+
+    def rollback(self):
+        self.round_trip()
+        self.db.rollback()
+
+    def close(self):
+        self.closed = True
+        self.prepared_statements = {}
+        self.db.close()
+
+    def isconnected(self):
+        return not self.closed
+
+
+class LocalPreparedStatement:
+
+    def __init__(self, connection, statement_id, procedure):
+        self.connection = connection
+        self.statement_id = statement_id
+        self.procedure = procedure
+
+
+class LocalCursor:
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = connection.db.cursor()
+        self.procedure_result = None
+
+    def execute(self, statement, parameters=None):
+        self.connection.round_trip()
+        self.procedure_result = None
+        self.cursor.execute(statement, parameters or ())
+
+    def executemany(self, statement, parameters):
+        self.connection.round_trip()
+        self.procedure_result = None
+        self.cursor.executemany(statement, parameters)
+
+    def prepare(self, statement):
+        self.connection.round_trip()
+        match = re.match(r'\s*CALL\s+"?LTN_DEVELOP"?\.(\w+)', statement, re.IGNORECASE)
+        if match is None or match.group(1).lower() not in PROCEDURES:
+            raise sqlite3.OperationalError('Unknown procedure: %s' % statement)
+        statements = self.connection.prepared_statements
+        statement_id = len(statements) + 1
+        statements[statement_id] = LocalPreparedStatement(self.connection, statement_id, match.group(1).lower())
+        return statement_id
+
+    def get_prepared_statement(self, statement_id):
+        statement = self.connection.prepared_statements.get(statement_id)
+        if statement is None:
+            raise sqlite3.OperationalError('Unknown prepared statement: %s' % statement_id)
+        return statement
+
+    def execute_prepared(self, prepared_statement, multi_row_parameters):
+        self.connection.round_trip()
+        if prepared_statement.connection is not self.connection or self.connection.closed:
+            raise sqlite3.OperationalError('Statement %s was not prepared in this session'
+                                           % prepared_statement.statement_id)
+        procedure = PROCEDURES[prepared_statement.procedure]
+        self.procedure_result = []
+        for parameters in multi_row_parameters:
+            self.procedure_result.extend(procedure(self.connection.db, parameters) or [])
+
+    def fetchone(self):
+        if self.procedure_result is not None:
+            return self.procedure_result.pop(0) if self.procedure_result else None
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size=None):
+        if self.procedure_result is not None:
+            rows, self.procedure_result = self.procedure_result[:size], self.procedure_result[size:]
+            return rows
+        self.connection.round_trip()
+        return self.cursor.fetchmany(size or self.cursor.arraysize)
+
+    def fetchall(self):
+        if self.procedure_result is not None:
+            rows, self.procedure_result = self.procedure_result, []
+            return rows
+        return self.cursor.fetchall()
+
+    def close(self):
+        self.cursor.close()
+
+
+def text_analysis_table(prefix, domain):
+    return '"LTN_DEVELOP"."%s%s"' % (prefix, domain)
+
+
+def create_text_analysis_tables(db, domain):
+    for prefix in TEXT_ANALYSIS_TABLES:
+        db.execute('CREATE TABLE IF NOT EXISTS %s (DOCUMENT_ID NVARCHAR(255), TA_OFFSET INTEGER, '
+                   'TA_TOKEN NVARCHAR(255), TA_TYPE NVARCHAR(255))' % text_analysis_table(prefix, domain))
+
+
+def get_document_content(db, params):
+    row = db.execute('SELECT TEXT FROM LTN_DEVELOP.DOCUMENTS WHERE ID = ?', (params['DOCUMENT_ID'],)).fetchone()
+    return [row] if row else []
+
+
+def add_document(db, params):
+    # the server escapes quotes for the dynamic SQL inside the HANA procedure
+    text = params['DOCUMENT_TEXT'].replace("''", "'")
+    db.execute('INSERT INTO LTN_DEVELOP.DOCUMENTS VALUES (?, ?, ?)',
+               (params['DOCUMENT_ID'], text, params['TASK']))
+
+
+def delete_document(db, params):
+    row = db.execute('SELECT t.DOMAIN FROM LTN_DEVELOP.TASKS t JOIN LTN_DEVELOP.DOCUMENTS d ON d.TASK = t.ID '
+                     'WHERE d.ID = ?', (params['DOCUMENT_ID'],)).fetchone()
+    if row and row[0]:
+        create_text_analysis_tables(db, row[0])
+        for prefix in TEXT_ANALYSIS_TABLES:
+            db.execute('DELETE FROM %s WHERE DOCUMENT_ID = ?' % text_analysis_table(prefix, row[0]),
+                       (params['DOCUMENT_ID'],))
+    db.execute('DELETE FROM LTN_DEVELOP.DOCUMENTS WHERE ID = ?', (params['DOCUMENT_ID'],))
+
+
+def add_task(db, params):
+    db.execute('INSERT INTO LTN_DEVELOP.TASKS (NAME, DOMAIN, CONFIG, AUTHOR) VALUES (?, ?, ?, ?)',
+               (params['TASK_NAME'], params['TABLE_NAME'], params['ER_ANALYSIS_CONFIG'], params['NEW_AUTHOR']))
+    create_text_analysis_tables(db, params['TABLE_NAME'])
+
+
+def update_task(db, params):
+    db.execute('UPDATE LTN_DEVELOP.TASKS SET NAME = ?, DOMAIN = ?, CONFIG = ?, AUTHOR = ? WHERE ID = ?',
+               (params['TASK_NAME'], params['TABLE_NAME'], params['ER_ANALYSIS_CONFIG'], params['NEW_AUTHOR'],
+                params['TASK_ID']))
+    create_text_analysis_tables(db, params['TABLE_NAME'])
+
+
+def delete_task(db, params):
+    for row in db.execute('SELECT ID FROM LTN_DEVELOP.DOCUMENTS WHERE TASK = ?', (params['TASK_ID'],)).fetchall():
+        for table, column in [('PAIRS', 'USER_DOC_ID'), ('OFFSETS', 'USER_DOC_ID'), ('ENTITIES', 'USER_DOC_ID')]:
+            db.execute('DELETE FROM LTN_DEVELOP.%s WHERE %s IN '
+                       '(SELECT ID FROM LTN_DEVELOP.USER_DOCUMENTS WHERE DOCUMENT_ID = ?)' % (table, column),
+                       (row[0],))
+        db.execute('DELETE FROM LTN_DEVELOP.USER_DOCUMENTS WHERE DOCUMENT_ID = ?', (row[0],))
+        delete_document(db, {'DOCUMENT_ID': row[0]})
+    db.execute('DELETE FROM LTN_DEVELOP.TASK_TYPES WHERE TASK_ID = ?', (params['TASK_ID'],))
+    db.execute('DELETE FROM LTN_DEVELOP.TASKS WHERE ID = ?', (params['TASK_ID'],))
+
+
+def ltn_train(db, params):
+    # the model is derived from the stored pairs whenever PREDICT_UD runs
+    pass
+
+
+def predict_ud(db, params):
+    """
+    Predicts a relation between every two consecutive entities of the user document,
+    using the relation type most often annotated between entities of the same types in the task.
+    """
+    user_doc_id = params['UD_ID']
+    known_relations = {}
+    for e1_type, e2_type, relation_type in db.execute(
+            'SELECT E1.TYPE_ID, E2.TYPE_ID, P.TYPE_ID FROM LTN_DEVELOP.PAIRS P '
+            'JOIN LTN_DEVELOP.ENTITIES E1 ON E1.ID = P.E1_ID AND E1.USER_DOC_ID = P.USER_DOC_ID '
+            'JOIN LTN_DEVELOP.ENTITIES E2 ON E2.ID = P.E2_ID AND E2.USER_DOC_ID = P.USER_DOC_ID '
+            'JOIN LTN_DEVELOP.USER_DOCUMENTS UD ON UD.ID = P.USER_DOC_ID '
+            'JOIN LTN_DEVELOP.DOCUMENTS D ON D.ID = UD.DOCUMENT_ID '
+            'WHERE D.TASK = ? AND P.DDI = 1 AND P.USER_DOC_ID != ?', (params['TASK_ID'], user_doc_id)):
+        known_relations.setdefault((e1_type, e2_type), Counter())[relation_type] += 1
+    entities = db.execute('SELECT E.ID, E.TYPE_ID FROM LTN_DEVELOP.ENTITIES E '
+                          'JOIN LTN_DEVELOP.OFFSETS O ON O.ENTITY_ID = E.ID AND O.USER_DOC_ID = E.USER_DOC_ID '
+                          'WHERE E.USER_DOC_ID = ? ORDER BY O."START"', (user_doc_id,)).fetchall()
+    pairs = []
+    for (e1_id, e1_type), (e2_id, e2_type) in zip(entities, entities[1:]):
+        candidates = known_relations.get((e1_type, e2_type))
+        if candidates:
+            pairs.append((candidates.most_common(1)[0][0], e1_id, e2_id))
+        else:
+            pairs.append((-1, e1_id, e2_id))
+    return pairs
+
+
+PROCEDURES = {
+    'get_document_content': get_document_content,
+    'add_document': add_document,
+    'delete_document': delete_document,
+    'add_task': add_task,
+    'update_task': update_task,
+    'delete_task': delete_task,
+    'ltn_train': ltn_train,
+    'predict_ud': predict_ud,
+}
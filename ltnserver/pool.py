@@ -0,0 +1,190 @@
+import time
+
+from threading import Condition
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection:
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.broken = False
+        self.last_used = time.time()
+        self.transaction_depth = 0
+        # prepared statements live as long as the session they were prepared in
+        self.statements = {}
+
+    def cursor(self):
+        return self.connection.cursor()
+
+    def commit(self):
+        return self.connection.commit()
+
+    def rollback(self):
+        return self.connection.rollback()
+
+    def prepared_statement(self, cursor, sql):
+        statement = self.statements.get(sql)
+        if statement is None:
+            statement_id = cursor.prepare(sql)
+            statement = cursor.get_prepared_statement(statement_id)
+            self.statements[sql] = statement
+        return statement
+
+    def close(self):
+        self.statements = {}
+        try:
+            self.connection.close()
+        except Exception, e:
+            print e
+
+    def is_healthy(self, ping_after):
+        try:
+            if hasattr(self.connection, 'isconnected') and not self.connection.isconnected():
+                return False
+            if time.time() - self.last_used > ping_after:
+                cursor = self.connection.cursor()
+                cursor.execute('SELECT 1 FROM DUMMY')
+                cursor.fetchone()
+                cursor.close()
+            return True
+        except Exception, e:
+            print 'Discarding unhealthy connection: ', e
+            return False
+
+
+class ConnectionPool:
+    """Bounded pool of database connections, checked out per request or per worker thread."""
+
+    def __init__(self, connect, min_size=1, max_size=10, timeout=30, ping_after=60):
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self.idle = []
+        self.size = 0
+        # id of the database connection -> PooledConnection wrapping it
+        self.connections = {}
+        self.condition = Condition()
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.replaced = 0
+        self.timeouts = 0
+        self.fill()
+
+    def fill(self):
+        with self.condition:
+            while self.size < self.min_size:
+                try:
+                    self.idle.append(self.open())
+                except Exception, e:
+                    print e
+                    break
+                self.size += 1
+
+    def checkout(self, blocking=True):
+        """Returns a connection, waiting up to the timeout for one. Without blocking, returns None instead."""
+        start = time.time()
+        deadline = start + self.timeout
+        while True:
+            connection = None
+            with self.condition:
+                while True:
+                    if self.idle:
+                        connection = self.idle.pop()
+                        break
+                    if self.size < self.max_size:
+                        self.size += 1
+                        break
+                    if not blocking:
+                        return None
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeout('No database connection available after %s seconds' % self.timeout)
+                    self.condition.wait(remaining)
+            if connection is None:
+                break
+            # pinging may take long, other threads can still check out and return connections meanwhile
+            if connection.is_healthy(self.ping_after):
+                with self.condition:
+                    self.record_wait(time.time() - start)
+                return connection
+            self.discard(connection)
+            with self.condition:
+                self.size -= 1
+                self.replaced += 1
+                self.condition.notify()
+        # open new connections outside of the lock, so other threads can still return theirs
+        try:
+            connection = self.open()
+        except Exception:
+            with self.condition:
+                self.size -= 1
+                self.condition.notify()
+            raise
+        with self.condition:
+            self.record_wait(time.time() - start)
+        return connection
+
+    def checkin(self, connection):
+        if not connection.broken:
+            # work left uncommitted by the borrower must not leak to the next one
+            try:
+                connection.rollback()
+            except Exception, e:
+                print 'Discarding connection that could not be rolled back: ', e
+                connection.broken = True
+        connection.transaction_depth = 0
+        with self.condition:
+            if connection.broken:
+                self.discard(connection)
+                self.size -= 1
+                self.replaced += 1
+            else:
+                connection.last_used = time.time()
+                self.idle.append(connection)
+            self.condition.notify()
+
+    def open(self):
+        connection = PooledConnection(self.connect())
+        self.connections[id(connection.connection)] = connection
+        return connection
+
+    def discard(self, connection):
+        self.connections.pop(id(connection.connection), None)
+        connection.close()
+
+    def owner(self, cursor):
+        """Returns the pooled connection the cursor was opened on, or None if it is not from this pool."""
+        return self.connections.get(id(cursor.connection))
+
+    def record_wait(self, waited):
+        self.checkouts += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    def close(self):
+        with self.condition:
+            for connection in self.idle:
+                self.discard(connection)
+            self.size -= len(self.idle)
+            self.idle = []
+
+    def stats(self):
+        with self.condition:
+            return {'size': self.size,
+                    'idle': len(self.idle),
+                    'in_use': self.size - len(self.idle),
+                    'min_size': self.min_size,
+                    'max_size': self.max_size,
+                    'checkouts': self.checkouts,
+                    'timeouts': self.timeouts,
+                    'replaced': self.replaced,
+                    'avg_wait_ms': 1000 * self.total_wait / self.checkouts if self.checkouts else 0.0,
+                    'max_wait_ms': 1000 * self.max_wait}
@@ -1,13 +1,31 @@
+import hashlib
 import json
+import time
+import uuid
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from threading import Lock
 
 from flask import request
 from flask_login import current_user
 
-from ltnserver import app, get_connection, respond_with
-from ltnserver.documents import load_user_doc_id, delete_user_document, save_document, load_document
+from ltnserver import app, get_connection, respond_with, execute_prepared, transaction, pooled_connection
+from ltnserver.cache import LRUCache
+from ltnserver.settings import get_settings
+from ltnserver.tagger import get_tagger, ENGINE_DICTIONARY
+from ltnserver.documents import load_user_doc_id, delete_user_document, save_document, load_document, \
+    clone_user_document, delete_user_documents, create_new_user_doc_id, fetch_texts_and_tasks, chunks, placeholders
+from ltnserver.formats import get_task_document_ids
+from ltnserver.training import get_model_version
 
 PREDICT_ENTITIES = 'entities'
 PREDICT_RELATIONS = 'relations'
+ENGINE_TEXT_ANALYSIS = 'text_analysis'
+MAX_JOBS = 100
+
+# prediction user document id -> (key of the prediction stored in it, its UPDATED_AT)
+predictions = LRUCache('predictions', 100000, size_of=lambda prediction: 1)
 
 
 def prediction_user_for_user(user_id):
@@ -21,44 +39,347 @@ def get_current_prediction_user(user_id, show_predictions):
         return user_id
 
 
+class PredictionFailed(Exception):
+    pass
+
+
 @app.route('/predict', methods=['POST'])
 def predict():
     data = request.get_json()
-    task_id = data['task_id']
-    jobs = data.get('jobs', [PREDICT_ENTITIES])
-    document_id = data['document_id']
-    user_id = data.get('user_id', current_user.get_id())
+    arguments = (data['task_id'], data.get('jobs', [PREDICT_ENTITIES]), data['document_id'],
+                 data.get('user_id', current_user.get_id()), data.get('current_state', None), current_user.get_id())
+    if data.get('async', False):
+        job = submit_prediction(*arguments)
+        if job is None:
+            return "Too many predictions are waiting, please try again later.", 503
+        return respond_with({'job_id': job.id}), 202
+    try:
+        return respond_with(run_prediction(*arguments))
+    except PredictionFailed, e:
+        return e.message, 500
+
+
+def run_prediction(task_id, jobs, document_id, user_id, current_state, current_user_id):
+    """Predicts the annotations of the document and returns it as seen by current_user_id, including predictions."""
     current_prediction_user = prediction_user_for_user(user_id)
     prediction_user_doc_id = load_user_doc_id(document_id, current_prediction_user)
-    delete_user_document(prediction_user_doc_id)
 
-    document_data = json.loads(data.get('current_state', None))
-    if document_data is None:
-        document_data = load_document(document_id, user_id)
+    with transaction() as connection:
+        if current_state is None:
+            document_data = load_document(document_id, user_id)
+            user_doc_id = load_user_doc_id(document_id, user_id)
+        else:
+            document_data = json.loads(current_state)
+            # the current status has to be saved first in order to disambiguate the ids of the annotations
+            user_doc_id = load_user_doc_id(document_id, current_user_id)
+            successful = save_document(document_data, user_doc_id, document_id, current_user_id, task_id)
+            if not successful:
+                raise PredictionFailed("Could not save the document")
+
+        model_version = get_model_version(task_id)
+        key = (document_id, str(task_id), model_version, get_entity_engine_version(task_id, jobs),
+               tuple(sorted(jobs)), get_fingerprint(document_data))
+        if model_version is not None and is_predicted(prediction_user_doc_id, key):
+            print "Reusing the predictions of %s" % prediction_user_doc_id
+            return load_document(document_id, current_user_id, True)
+
+        delete_user_document(prediction_user_doc_id)
+        if PREDICT_ENTITIES in jobs:
+            cursor = connection.cursor()
+            cursor.execute('INSERT INTO "LTN_DEVELOP"."USER_DOCUMENTS" '
+                           'VALUES (?, ?, ?, 0, current_timestamp, current_timestamp)',
+                           (prediction_user_doc_id, current_prediction_user, document_id,))
+            cursor.close()
+            predict_entities(document_id, task_id, prediction_user_doc_id)
+        if PREDICT_RELATIONS in jobs:
+            if PREDICT_ENTITIES not in jobs:
+                clone_user_document(user_doc_id, prediction_user_doc_id, document_id, current_prediction_user, False)
+            predicted_pairs = predict_relations(prediction_user_doc_id, task_id)
+            if PREDICT_ENTITIES not in jobs:
+                remove_entities_without_relations(predicted_pairs, document_data, prediction_user_doc_id)
+    if model_version is not None:
+        predictions.put(prediction_user_doc_id, (key, get_updated_at(prediction_user_doc_id)))
     else:
-        # the current status has to be saved first in order to disambiguate the ids of the annotations
-        user_doc_id = load_user_doc_id(document_id, current_user.get_id())
-        successful = save_document(document_data, user_doc_id, document_id, current_user.get_id(), task_id)
-        if not successful:
-            return "Could not save the document", 500
-
-    if PREDICT_ENTITIES in jobs:
-        cursor = get_connection().cursor()
-        cursor.execute('INSERT INTO "LTN_DEVELOP"."USER_DOCUMENTS" '
+        predictions.invalidate(prediction_user_doc_id)
+
+    return load_document(document_id, current_user_id, True)
+
+
+class PredictionJob:
+    """A prediction waiting for or running in the prediction workers."""
+
+    def __init__(self, key, arguments):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.arguments = arguments
+        self.user_id = arguments[5]
+        self.state = 'queued'
+        self.error = None
+        self.document = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def is_done(self):
+        return self.state in ['finished', 'failed']
+
+    def to_dict(self):
+        result = {'id': self.id,
+                  'state': self.state,
+                  'error': self.error,
+                  'document_id': self.arguments[2],
+                  'wait_ms': 1000 * ((self.started_at or time.time()) - self.created_at),
+                  'run_ms': 1000 * ((self.finished_at or time.time()) - self.started_at) if self.started_at else 0.0}
+        if self.state == 'finished':
+            result['document'] = self.document
+        return result
+
+
+class TaskPredictionJob:
+    """Prediction of all documents of a task, made chunk by chunk by one of the prediction workers."""
+
+    def __init__(self, key, task_id, jobs, user_id, current_user_id):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.task_id = task_id
+        self.jobs = jobs
+        self.prediction_user = prediction_user_for_user(user_id)
+        self.user_id = current_user_id
+        self.state = 'queued'
+        self.error = None
+        self.total = 0
+        self.processed = 0
+        self.failed = 0
+        self.entities = 0
+        self.relations = 0
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def is_done(self):
+        return self.state in ['finished', 'failed']
+
+    def to_dict(self):
+        run_time = (self.finished_at or time.time()) - self.started_at if self.started_at else 0.0
+        return {'id': self.id,
+                'state': self.state,
+                'error': self.error,
+                'task_id': self.task_id,
+                'total': self.total,
+                'processed': self.processed,
+                'failed': self.failed,
+                'entities': self.entities,
+                'relations': self.relations,
+                'wait_ms': 1000 * ((self.started_at or time.time()) - self.created_at),
+                'run_ms': 1000 * run_time,
+                'documents_per_second': self.processed / run_time if run_time else 0.0}
+
+
+class PredictionStats:
+
+    def __init__(self):
+        self.submitted = 0
+        self.deduplicated = 0
+        self.rejected = 0
+        self.finished = 0
+        self.failed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_run = 0.0
+        self.max_run = 0.0
+
+    def record(self, job):
+        waited = job.started_at - job.created_at
+        ran = job.finished_at - job.started_at
+        if job.state == 'finished':
+            self.finished += 1
+        else:
+            self.failed += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        self.total_run += ran
+        self.max_run = max(self.max_run, ran)
+
+    def to_dict(self):
+        done = self.finished + self.failed
+        return {'submitted': self.submitted,
+                'deduplicated': self.deduplicated,
+                'rejected': self.rejected,
+                'finished': self.finished,
+                'failed': self.failed,
+                'avg_wait_ms': 1000 * self.total_wait / done if done else 0.0,
+                'max_wait_ms': 1000 * self.max_wait,
+                'avg_run_ms': 1000 * self.total_run / done if done else 0.0,
+                'max_run_ms': 1000 * self.max_run}
+
+
+prediction_settings = get_settings('prediction') or {}
+prediction_jobs = OrderedDict()
+pending_predictions = {}
+prediction_stats = PredictionStats()
+prediction_lock = Lock()
+prediction_workers = None
+
+
+def get_prediction_workers():
+    global prediction_workers
+    with prediction_lock:
+        if prediction_workers is None:
+            prediction_workers = ThreadPool(prediction_settings.get('workers', 2))
+    return prediction_workers
+
+
+def submit_prediction(task_id, jobs, document_id, user_id, current_state, current_user_id):
+    """
+    Queues a prediction for the workers. Identical predictions that are still waiting or running are
+    shared instead of being queued twice. Returns None if the queue is full.
+    """
+    arguments = (task_id, jobs, document_id, user_id, current_state, current_user_id)
+    key = (str(task_id), tuple(sorted(jobs)), document_id, user_id, current_user_id,
+           hashlib.md5(current_state.encode('utf-8')).hexdigest() if current_state is not None else None)
+    return submit_job(key, lambda: PredictionJob(key, arguments), predict_document)
+
+
+def submit_job(key, create_job, run):
+    workers = get_prediction_workers()
+    with prediction_lock:
+        job = pending_predictions.get(key)
+        if job is not None:
+            prediction_stats.deduplicated += 1
+            return job
+        if len(pending_predictions) >= prediction_settings.get('max_queued', 100):
+            prediction_stats.rejected += 1
+            return None
+        job = create_job()
+        pending_predictions[key] = job
+        prediction_jobs[job.id] = job
+        for job_id in [other.id for other in prediction_jobs.itervalues()
+                       if other.is_done()][:max(0, len(prediction_jobs) - MAX_JOBS)]:
+            del prediction_jobs[job_id]
+        prediction_stats.submitted += 1
+    workers.apply_async(run_prediction_job, (job, run))
+    return job
+
+
+def predict_document(job):
+    job.document = run_prediction(*job.arguments)
+
+
+def run_prediction_job(job, run):
+    job.started_at = time.time()
+    job.state = 'running'
+    try:
+        with pooled_connection():
+            run(job)
+        job.state = 'finished'
+    except Exception, e:
+        print 'Prediction job %s failed: ' % job.id, e
+        job.error = str(e)
+        job.state = 'failed'
+    job.finished_at = time.time()
+    with prediction_lock:
+        pending_predictions.pop(job.key, None)
+        prediction_stats.record(job)
+
+
+@app.route('/tasks/<task_id>/predict', methods=['POST'])
+def predict_task(task_id):
+    data = request.get_json() or {}
+    jobs = data.get('jobs', [PREDICT_ENTITIES, PREDICT_RELATIONS])
+    if PREDICT_ENTITIES not in jobs:
+        return "Predicting the documents of a task requires predicting entities.", 400
+    user_id = data.get('user_id', current_user.get_id())
+    key = ('task', str(task_id), tuple(sorted(jobs)), user_id)
+    job = submit_job(key, lambda: TaskPredictionJob(key, task_id, jobs, user_id, current_user.get_id()),
+                     predict_task_documents)
+    if job is None:
+        return "Too many predictions are waiting, please try again later.", 503
+    return respond_with({'job_id': job.id}), 202
+
+
+def predict_task_documents(job):
+    """Replaces the predictions of all documents of the task, committing once per chunk of documents."""
+    document_ids = get_task_document_ids(job.task_id)
+    job.total = len(document_ids)
+    cursor = get_connection().cursor()
+    domain = get_task_domain(cursor, job.task_id)
+    cursor.close()
+    for chunk in chunks(document_ids, prediction_settings.get('batch_size', 100)):
+        user_doc_ids = {}
+        try:
+            with transaction() as connection:
+                cursor = connection.cursor()
+                user_doc_ids = replace_prediction_user_documents(cursor, chunk, job.prediction_user)
+                job.entities += predict_entities_of_documents(cursor, user_doc_ids, job.task_id, domain)
+                if PREDICT_RELATIONS in job.jobs:
+                    job.relations += predict_relations_of_documents(cursor, user_doc_ids.values(), job.task_id)
+                cursor.close()
+        except Exception, e:
+            print 'Predicting documents %s failed: ' % ', '.join(chunk), e
+            job.failed += len(chunk)
+            job.error = str(e)
+        for user_doc_id in user_doc_ids.itervalues():
+            predictions.invalidate(user_doc_id)
+        job.processed += len(chunk)
+
+
+def replace_prediction_user_documents(cursor, document_ids, prediction_user):
+    """Empties the prediction user documents of the documents and returns them by document id."""
+    cursor.execute('SELECT DOCUMENT_ID, ID FROM LTN_DEVELOP.USER_DOCUMENTS WHERE USER_ID = ? AND DOCUMENT_ID IN (%s)'
+                   % placeholders(document_ids), (prediction_user,) + tuple(document_ids))
+    user_doc_ids = dict((document_id, create_new_user_doc_id(prediction_user, document_id))
+                        for document_id in document_ids)
+    user_doc_ids.update((row[0], str(row[1])) for row in cursor.fetchall())
+    delete_user_documents(user_doc_ids.values())
+    cursor.executemany('INSERT INTO "LTN_DEVELOP"."USER_DOCUMENTS" '
                        'VALUES (?, ?, ?, 0, current_timestamp, current_timestamp)',
-                       (prediction_user_doc_id, current_prediction_user, document_id,))
-        cursor.close()
-        get_connection().commit()
-        predict_entities(document_id, task_id, prediction_user_doc_id)
-    if PREDICT_RELATIONS in jobs:
-        if PREDICT_ENTITIES not in jobs:
-            save_document(document_data, prediction_user_doc_id, document_id, current_prediction_user, task_id, False)
-        predicted_pairs = predict_relations(prediction_user_doc_id, task_id)
-        if PREDICT_ENTITIES not in jobs:
-            remove_entities_without_relations(predicted_pairs, document_data, prediction_user_doc_id)
+                       [(user_doc_id, prediction_user, document_id)
+                        for document_id, user_doc_id in user_doc_ids.iteritems()])
+    return user_doc_ids
+
+
+@app.route('/predict/jobs/<job_id>')
+def get_prediction_job(job_id):
+    job = prediction_jobs.get(job_id)
+    if job is None or job.user_id != current_user.get_id():
+        return 'Unknown prediction job.', 404
+    return respond_with(job.to_dict())
+
+
+@app.route('/stats/predictions')
+def get_prediction_stats():
+    with prediction_lock:
+        stats = prediction_stats.to_dict()
+        stats['queued'] = len([job for job in pending_predictions.itervalues() if job.state == 'queued'])
+        stats['running'] = len([job for job in pending_predictions.itervalues() if job.state == 'running'])
+    stats['workers'] = prediction_settings.get('workers', 2)
+    return respond_with(stats)
+
 
-    document_data = load_document(document_id, current_user.get_id(), True)
-    return respond_with(document_data)
+def get_fingerprint(document_data):
+    """Hash of the annotations of the current user, which are the input of the predictions."""
+    denotations = sorted((d.get('originalId', d['id']), d['span']['begin'], d['span']['end'],
+                          (d.get('obj') or {}).get('id'), (d.get('obj') or {}).get('label'))
+                         for d in document_data['denotations'] if d.get('userId', 0) == 0)
+    relations = sorted((r['subj'], r['obj'], (r.get('pred') or {}).get('id')) for r in document_data['relations'])
+    return hashlib.md5(repr((denotations, relations))).hexdigest()
+
+
+def get_updated_at(user_doc_id):
+    cursor = get_connection().cursor()
+    cursor.execute('SELECT UPDATED_AT FROM LTN_DEVELOP.USER_DOCUMENTS WHERE ID = ?', (user_doc_id,))
+    row = cursor.fetchone()
+    cursor.close()
+    return row[0] if row else None
+
+
+def is_predicted(prediction_user_doc_id, key):
+    """Whether the prediction user document still holds the predictions made for key."""
+    prediction = predictions.get(prediction_user_doc_id)
+    if prediction is None or prediction[0] != key:
+        return False
+    updated_at = get_updated_at(prediction_user_doc_id)
+    return updated_at is not None and updated_at == prediction[1]
 
 
 def remove_entities_without_relations(pairs, document_data, user_doc_id):
@@ -71,79 +392,136 @@ def remove_entities_without_relations(pairs, document_data, user_doc_id):
     map(add_entities_to_set, pairs)
     to_be_removed = map(lambda e: e['id'], filter(lambda d: d['id'] not in used_entities, document_data['denotations']))
 
-    cursor = get_connection().cursor()
-    id_string = "('" + "', '".join(to_be_removed) + "')"
-    cursor.execute('DELETE FROM LTN_DEVELOP.ENTITIES WHERE ID IN ' + id_string + ' AND USER_DOC_ID = ?', (user_doc_id,))
-    get_connection().commit()
-    cursor.close()
+    with transaction() as connection:
+        cursor = connection.cursor()
+        id_string = "('" + "', '".join(to_be_removed) + "')"
+        cursor.execute('DELETE FROM LTN_DEVELOP.ENTITIES WHERE ID IN ' + id_string + ' AND USER_DOC_ID = ?',
+                       (user_doc_id,))
+        cursor.close()
+
+
+PREDICTED_ENTITIES = """
+    select distinct
+      fti.ta_offset as "start",
+      fti.ta_offset + length(fti.ta_token) as "end",
+      fti.ta_token,
+      tt.id,
+      fti.document_id
+    from "LTN_DEVELOP"."%s" fti
+    join "LTN_DEVELOP"."TYPES" t on (t.code = fti.ta_type or
+      (t.code = 'T092' and fti.ta_type like 'ORGANIZATION%%'))
+    join "LTN_DEVELOP"."TASK_TYPES" tt on t.id = tt.type_id and tt.task_id = ?
+    join "LTN_DEVELOP"."%s" pos on fti.document_id = pos.document_id and fti.ta_offset = pos.ta_offset
+    where fti.document_id in (%s)
+      and length(fti.ta_token) >= 3
+      and pos.ta_type in ('noun', 'abbreviation', 'proper name')
+    order by fti.document_id, fti.ta_offset
+"""
+
+
+def get_task_domain(cursor, task_id):
+    cursor.execute('select "DOMAIN" from LTN_DEVELOP.tasks WHERE id = ?', (task_id,))
+    return cursor.fetchone()[0]
 
 
 def predict_entities(document_id, task_id, target_user_document_id):
     cursor = get_connection().cursor()
+    predict_entities_of_documents(cursor, {document_id: target_user_document_id}, task_id,
+                                  get_task_domain(cursor, task_id))
+    cursor.close()
 
-    cursor.execute('select "DOMAIN" from LTN_DEVELOP.tasks WHERE id = ?', (task_id,))
-    table_name = cursor.fetchone()[0]
-    index_name = "$TA_INDEX_" + table_name
-    er_index_name = "$TA_ER_INDEX_" + table_name
-
-    cursor.execute("""
-        select distinct
-          fti.ta_offset as "start",
-          fti.ta_offset + length(fti.ta_token) as "end",
-          fti.ta_token,
-          tt.id
-        from "LTN_DEVELOP"."%s" fti
-        join "LTN_DEVELOP"."TYPES" t on (t.code = fti.ta_type or
-          (t.code = 'T092' and fti.ta_type like 'ORGANIZATION%%'))
-        join "LTN_DEVELOP"."TASK_TYPES" tt on t.id = tt.type_id and tt.task_id = ?
-        join "LTN_DEVELOP"."%s" pos on fti.document_id = pos.document_id and fti.ta_offset = pos.ta_offset
-        where fti.document_id = ?
-          and length(fti.ta_token) >= 3
-          and pos.ta_type in ('noun', 'abbreviation', 'proper name')
-        order by fti.ta_offset
-    """ % (er_index_name, index_name), (task_id, document_id,))
+
+def predict_entities_of_documents(cursor, user_doc_ids, task_id, domain):
+    """
+    Stores the entities found by the configured entity engine, user_doc_ids maps the ids of the
+    documents to the user documents receiving their entities. Returns the number of entities.
+    """
+    find_entities = entity_engines[prediction_settings.get('entity_engine', ENGINE_TEXT_ANALYSIS)]
 
     entities = list()
     offsets = list()
 
-    for row in cursor.fetchall():
+    for row in find_entities(cursor, list(user_doc_ids), task_id, domain):
+        target_user_document_id = user_doc_ids[row[4]]
         entity_id = "%s_%s_%s_%s" % (target_user_document_id, row[0], row[2], row[3])
         entity_id = entity_id.replace(' ', '_').replace('/', '_')
         entities.append((entity_id, target_user_document_id, int(row[3]), None, row[2]))
         offsets.append((row[0], row[1], entity_id, target_user_document_id))
 
-    cursor.executemany('insert into "LTN_DEVELOP"."ENTITIES" VALUES (?, ?, ?, ?, ?)', entities)
-    cursor.executemany('insert into "LTN_DEVELOP"."OFFSETS" VALUES (?, ?, ?, ?)', offsets)
-    get_connection().commit()
-    cursor.close()
+    with transaction():
+        cursor.executemany('insert into "LTN_DEVELOP"."ENTITIES" VALUES (?, ?, ?, ?, ?)', entities)
+        cursor.executemany('insert into "LTN_DEVELOP"."OFFSETS" VALUES (?, ?, ?, ?)', offsets)
+    return len(entities)
+
+
+def find_entities_in_text_analysis(cursor, document_ids, task_id, domain):
+    """Entities found by the text analysis of HANA, as (start, end, token, task type id, document id)."""
+    cursor.execute(PREDICTED_ENTITIES % ("$TA_ER_INDEX_" + domain, "$TA_INDEX_" + domain, placeholders(document_ids)),
+                   (task_id,) + tuple(document_ids))
+    return cursor.fetchall()
+
+
+def find_entities_in_dictionary(cursor, document_ids, task_id, domain):
+    """Occurrences of the terms annotated in the task so far, as (start, end, token, task type id, document id)."""
+    tagger = get_tagger(task_id)
+    rows = []
+    for document_id, (text, _) in fetch_texts_and_tasks(cursor, document_ids).iteritems():
+        if text is not None:
+            rows.extend((start, end, token, type_id, document_id) for start, end, token, type_id in tagger.tag(text))
+    return rows
+
+
+# engines finding the entities to predict, selected with entity_engine in the prediction settings
+entity_engines = {ENGINE_TEXT_ANALYSIS: find_entities_in_text_analysis,
+                  ENGINE_DICTIONARY: find_entities_in_dictionary}
+
+
+def get_entity_engine_version(task_id, jobs):
+    """Changes whenever the entities found for the task may change without retraining, i.e. with its tagger."""
+    if PREDICT_ENTITIES in jobs and prediction_settings.get('entity_engine') == ENGINE_DICTIONARY:
+        return get_tagger(task_id).version
+    return None
 
 
 def predict_relations(user_document_id, task_id):
     cursor = get_connection().cursor()
+    pairs = fetch_predicted_relations(cursor, user_document_id, task_id)
+    cursor.close()
+
+    return store_predicted_relations(pairs, user_document_id)
+
 
+def fetch_predicted_relations(cursor, user_document_id, task_id):
     sql_to_prepare = 'CALL LTN_DEVELOP.PREDICT_UD (?, ?, ?)'
     params = {'UD_ID': user_document_id,
               'TASK_ID': str(task_id)}
-    psid = cursor.prepare(sql_to_prepare)
-    ps = cursor.get_prepared_statement(psid)
-    cursor.execute_prepared(ps, [params])
-    pairs = cursor.fetchall()
+    execute_prepared(cursor, sql_to_prepare, params)
+    return cursor.fetchall()
 
-    return store_predicted_relations(pairs, user_document_id)
 
+def predict_relations_of_documents(cursor, user_document_ids, task_id):
+    """PREDICT_UD handles one user document per call, but the pairs of all of them are stored at once."""
+    tuples = []
+    for user_document_id in user_document_ids:
+        pairs = filter(lambda x: x[0] != -1, fetch_predicted_relations(cursor, user_document_id, task_id))
+        tuples.extend((e1_id, e2_id, user_document_id, 1, ddi) for ddi, e1_id, e2_id in pairs)
+    cursor.executemany(
+        "INSERT INTO LTN_DEVELOP.PAIRS (E1_ID, E2_ID, USER_DOC_ID, DDI, TYPE_ID) VALUES (?, ?, ?, ?, ?)", tuples
+    )
+    return len(tuples)
 
-def store_predicted_relations(pairs, user_document_id):
-    cursor = get_connection().cursor()
-    cursor.execute("DELETE FROM LTN_DEVELOP.PAIRS WHERE USER_DOC_ID = ?", (user_document_id,))
 
+def store_predicted_relations(pairs, user_document_id):
     tuples = []
     pairs = filter(lambda x: x[0] != -1, pairs)
     for ddi, e1_id, e2_id in pairs:
         tuples.append((e1_id, e2_id, user_document_id, 1, ddi))
 
-    cursor.executemany(
-        "INSERT INTO LTN_DEVELOP.PAIRS (E1_ID, E2_ID, USER_DOC_ID, DDI, TYPE_ID) VALUES (?, ?, ?, ?, ?)", tuples
-    )
-    get_connection().commit()
-    cursor.close()
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM LTN_DEVELOP.PAIRS WHERE USER_DOC_ID = ?", (user_document_id,))
+        cursor.executemany(
+            "INSERT INTO LTN_DEVELOP.PAIRS (E1_ID, E2_ID, USER_DOC_ID, DDI, TYPE_ID) VALUES (?, ?, ?, ?, ?)", tuples
+        )
+        cursor.close()
     return tuples
@@ -0,0 +1,130 @@
+import json
+import os
+
+from multiprocessing.pool import ThreadPool
+from threading import Lock, local
+
+from flask import request
+
+from ltnserver import app, respond_with
+from ltnserver.cache import LRUCache
+from ltnserver.settings import get_settings, get_root_path
+
+MAX_BATCH_SIZE = 500
+
+pubmed_settings = get_settings('pubmed') or {}
+abstracts = LRUCache('pubmed_abstracts', (get_settings('cache') or {}).get('pubmed_abstract_bytes', 16 * 1024 * 1024))
+fetcher = None
+fetch_workers = None
+fetcher_lock = Lock()
+
+
+class InvalidPubMedId(Exception):
+    pass
+
+
+class MetapubFetcher:
+    """Fetches abstracts from NCBI through metapub, which keeps its own cache on disk."""
+
+    def __init__(self, cachedir='.cache/'):
+        self.cachedir = cachedir
+        # metapub's fetcher and its disk cache are not shared between threads
+        self.fetchers = local()
+
+    def fetch_abstract(self, pubmed_id):
+        from metapub import PubMedFetcher
+        from metapub.exceptions import InvalidPMID
+        if getattr(self.fetchers, 'fetcher', None) is None:
+            self.fetchers.fetcher = PubMedFetcher(cachedir=self.cachedir)
+        try:
+            return self.fetchers.fetcher.article_by_pmid(pubmed_id).abstract
+        except InvalidPMID:
+            raise InvalidPubMedId(pubmed_id)
+
+
+class FixtureFetcher:
+    """Serves abstracts from a JSON file mapping PubMed ids to abstracts, e.g. for tests and local development."""
+
+    def __init__(self, path):
+        with open(path if os.path.isabs(path) else get_root_path(path)) as f:
+            self.abstracts = json.load(f)
+
+    def fetch_abstract(self, pubmed_id):
+        if pubmed_id not in self.abstracts:
+            raise InvalidPubMedId(pubmed_id)
+        return self.abstracts[pubmed_id]
+
+
+def get_fetcher():
+    global fetcher
+    with fetcher_lock:
+        if fetcher is None:
+            if pubmed_settings.get('backend') == 'fixture':
+                fetcher = FixtureFetcher(pubmed_settings['fixture'])
+            else:
+                fetcher = MetapubFetcher(pubmed_settings.get('cachedir', '.cache/'))
+    return fetcher
+
+
+def set_fetcher(new_fetcher):
+    """Replaces the backend, which only needs a fetch_abstract(pubmed_id) method."""
+    global fetcher
+    with fetcher_lock:
+        fetcher = new_fetcher
+    abstracts.clear()
+
+
+def get_fetch_workers():
+    global fetch_workers
+    with fetcher_lock:
+        if fetch_workers is None:
+            fetch_workers = ThreadPool(pubmed_settings.get('workers', 4))
+    return fetch_workers
+
+
+def fetch_abstract(pubmed_id):
+    abstract = abstracts.get(pubmed_id)
+    if abstract is None:
+        abstract = get_fetcher().fetch_abstract(pubmed_id)
+        if abstract is not None:
+            abstracts.put(pubmed_id, abstract)
+    return abstract
+
+
+def try_fetching_abstract(pubmed_id):
+    try:
+        return pubmed_id, fetch_abstract(pubmed_id), None
+    except InvalidPubMedId:
+        return pubmed_id, None, 'Invalid PubmedID'
+    except Exception, e:
+        print 'Error while fetching %s: ' % pubmed_id, e
+        return pubmed_id, None, str(e)
+
+
+@app.route('/pubmed/<pubmed_id>')
+def fetch_pubmed_abstract(pubmed_id):
+    try:
+        return respond_with(fetch_abstract(pubmed_id))
+    except InvalidPubMedId:
+        return 'Invalid PubmedID', 500
+
+
+@app.route('/pubmed/batch', methods=['POST'])
+def fetch_pubmed_abstracts():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return 'The request body must be a JSON object.', 400
+    pubmed_ids = data.get('pubmed_ids', [])
+    if not isinstance(pubmed_ids, list) or not all(isinstance(pubmed_id, (basestring, int)) and
+                                                   not isinstance(pubmed_id, bool) for pubmed_id in pubmed_ids):
+        return 'pubmed_ids must be a list of PubMed ids.', 400
+    pubmed_ids = [unicode(pubmed_id) for pubmed_id in pubmed_ids]
+    if len(pubmed_ids) > MAX_BATCH_SIZE:
+        return 'At most %d abstracts can be fetched at once.' % MAX_BATCH_SIZE, 400
+    result = {'abstracts': {}, 'errors': {}}
+    for pubmed_id, abstract, error in get_fetch_workers().map(try_fetching_abstract, set(pubmed_ids)):
+        if error is None:
+            result['abstracts'][pubmed_id] = abstract
+        else:
+            result['errors'][pubmed_id] = error
+    return respond_with(result)
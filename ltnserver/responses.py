@@ -0,0 +1,116 @@
+import json
+import time
+import zlib
+
+from threading import Lock
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+
+def get_json_encoder():
+    """Returns the fastest available encoder producing the same output as json.dumps for our payloads."""
+    if ujson is not None:
+        return 'ujson', lambda data: ujson.dumps(data, ensure_ascii=True, escape_forward_slashes=False)
+    if simplejson is not None:
+        return 'simplejson', simplejson.dumps
+    return 'json', json.dumps
+
+
+encoder_name, encode_json = get_json_encoder()
+
+
+COMPRESSIBLE_TYPES = ['application/json', 'text/xml', 'application/xml', 'text/plain']
+
+
+def compressor_for(encoding, level):
+    if encoding == 'gzip':
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return zlib.compressobj(level)
+
+
+def compress(data, encoding, level):
+    compressor = compressor_for(encoding, level)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_stream(chunks, encoding, level):
+    compressor = compressor_for(encoding, level)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def compress_response(response, accept_encodings, min_size, level):
+    """Compresses the body with the encoding preferred by the client, returns the encoding used or None."""
+    if response.direct_passthrough or 'Content-Encoding' in response.headers \
+            or response.status_code < 200 or response.status_code in [204, 304] \
+            or response.mimetype not in COMPRESSIBLE_TYPES:
+        return None
+    response.vary.add('Accept-Encoding')
+    encoding = accept_encodings.best_match(['gzip', 'deflate'])
+    if encoding is None:
+        return None
+    if response.is_streamed:
+        # the size of a streamed body is unknown up front, chunks are compressed as they are generated
+        response.response = compress_stream(response.response, encoding, level)
+        response.headers.pop('Content-Length', None)
+    elif response.content_length < min_size:
+        return None
+    else:
+        response.set_data(compress(response.get_data(), encoding, level))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        # the compressed body is no longer byte-identical to the uncompressed one
+        response.set_etag(etag, weak=True)
+    return encoding
+
+
+class ResponseStats:
+    """Encode times and compression ratios per route."""
+
+    def __init__(self):
+        self.routes = {}
+        self.lock = Lock()
+
+    def record(self, route, encode_time, raw_size, sent_size):
+        with self.lock:
+            stats = self.routes.setdefault(route, {'responses': 0, 'encoded': 0, 'encode_ms': 0.0,
+                                                   'raw_bytes': 0, 'sent_bytes': 0})
+            stats['responses'] += 1
+            if encode_time is not None:
+                stats['encoded'] += 1
+                stats['encode_ms'] += 1000 * encode_time
+            stats['raw_bytes'] += raw_size
+            stats['sent_bytes'] += sent_size
+
+    def stats(self):
+        with self.lock:
+            result = {}
+            for route, stats in self.routes.iteritems():
+                result[route] = {'responses': stats['responses'],
+                                 'avg_encode_ms': stats['encode_ms'] / stats['encoded'] if stats['encoded'] else 0.0,
+                                 'raw_bytes': stats['raw_bytes'],
+                                 'sent_bytes': stats['sent_bytes'],
+                                 'compression_ratio': float(stats['raw_bytes']) / stats['sent_bytes']
+                                 if stats['sent_bytes'] else 1.0}
+            return {'encoder': encoder_name, 'routes': result}
+
+
+response_stats = ResponseStats()
+
+
+def timed_encode(data):
+    start = time.time()
+    encoded = encode_json(data)
+    return encoded, time.time() - start
@@ -10,5 +10,6 @@ def get_root_path(path):
 
 
 def get_settings(key):
-    with open(get_root_path('secrets.json')) as f:
+    # LTN_SETTINGS allows running against another configuration, e.g. the local database for benchmarks
+    with open(os.environ.get('LTN_SETTINGS', get_root_path('secrets.json'))) as f:
         return json.load(f).get(key)
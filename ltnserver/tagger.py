@@ -0,0 +1,262 @@
+from collections import Counter, deque
+from itertools import count
+from threading import Lock
+
+from ltnserver import app, get_connection, respond_with
+from ltnserver.documents import fetch_texts_and_tasks
+from ltnserver.settings import get_settings
+
+MIN_TERM_LENGTH = 3
+ENGINE_DICTIONARY = 'dictionary'
+
+prediction_settings = get_settings('prediction') or {}
+
+# task id -> DictionaryTagger of the entities annotated in the task so far
+taggers = {}
+# task id -> TaggerLoads in progress
+loads = {}
+taggers_lock = Lock()
+# every change of any tagger gets a new version, so predictions of an older state are not reused
+versions = count(1)
+
+
+class Automaton:
+    """
+    Aho-Corasick automaton finding all occurrences of a set of terms in a single pass over a text.
+    Terms can be added at any time, the failure links are recomputed before the next search.
+    """
+
+    def __init__(self):
+        self.transitions = [{}]
+        self.terms = [None]
+        self.failures = [0]
+        self.outputs = [None]
+        self.built = True
+
+    def add(self, term):
+        state = 0
+        for character in term:
+            next_state = self.transitions[state].get(character)
+            if next_state is None:
+                next_state = len(self.transitions)
+                self.transitions.append({})
+                self.terms.append(None)
+                self.failures.append(0)
+                self.outputs.append(None)
+                self.transitions[state][character] = next_state
+            state = next_state
+        if self.terms[state] is None:
+            self.terms[state] = term
+            self.built = False
+
+    def build(self):
+        queue = deque(self.transitions[0].itervalues())
+        for state in queue:
+            self.failures[state] = 0
+        while queue:
+            state = queue.popleft()
+            failure = self.failures[state]
+            # the state to continue reporting matches from, ending at the same position
+            self.outputs[state] = failure if self.terms[failure] is not None else self.outputs[failure]
+            for character, next_state in self.transitions[state].iteritems():
+                fallback = failure
+                while fallback and character not in self.transitions[fallback]:
+                    fallback = self.failures[fallback]
+                self.failures[next_state] = self.transitions[fallback].get(character, 0)
+                queue.append(next_state)
+        self.built = True
+
+    def find(self, text):
+        """Generates (start, end, term) of all occurrences, including overlapping ones."""
+        if not self.built:
+            self.build()
+        state = 0
+        for position, character in enumerate(text):
+            while state and character not in self.transitions[state]:
+                state = self.failures[state]
+            state = self.transitions[state].get(character, 0)
+            match = state if self.terms[state] is not None else self.outputs[state]
+            while match:
+                term = self.terms[match]
+                yield position + 1 - len(term), position + 1, term
+                match = self.outputs[match]
+
+
+class DictionaryTagger:
+    """Tags the terms annotated in a task with the entity type they were annotated with most often."""
+
+    def __init__(self):
+        self.automaton = Automaton()
+        self.types = {}
+        self.lock = Lock()
+        self.version = next(versions)
+
+    def add(self, term, type_id, count=1):
+        term = normalize_term(term)
+        if len(term) < MIN_TERM_LENGTH or type_id is None:
+            return
+        with self.lock:
+            if term not in self.types:
+                self.types[term] = Counter()
+                self.automaton.add(term)
+            self.types[term][int(type_id)] += count
+            self.version = next(versions)
+
+    def remove(self, term, type_id, count=1):
+        # the automaton keeps terms that are no longer annotated, they are skipped when tagging
+        term = normalize_term(term)
+        if type_id is None:
+            return
+        with self.lock:
+            types = self.types.get(term)
+            if types is None:
+                return
+            types[int(type_id)] -= count
+            if types[int(type_id)] <= 0:
+                del types[int(type_id)]
+            if not types:
+                del self.types[term]
+            self.version = next(versions)
+
+    def tag(self, text):
+        """Returns (start, end, text, type id) of the longest matches on word boundaries, leftmost first."""
+        normalized = text.lower()
+        if len(normalized) != len(text):
+            normalized = text
+        with self.lock:
+            matches = [(start, end, self.types[term].most_common(1)[0][0])
+                       for start, end, term in self.automaton.find(normalized)
+                       if term in self.types and is_word(text, start, end)]
+        entities = []
+        covered = 0
+        for start, end, type_id in sorted(matches, key=lambda match: (match[0], -match[1])):
+            if start >= covered:
+                entities.append((start, end, text[start:end], type_id))
+                covered = end
+        return entities
+
+    def size(self):
+        with self.lock:
+            return len(self.types)
+
+
+def normalize_term(term):
+    return term.strip().lower()
+
+
+def is_word(text, start, end):
+    return (start == 0 or not text[start - 1].isalnum()) and (end == len(text) or not text[end].isalnum())
+
+
+class TaggerLoad:
+    """Annotations saved while a tagger is loaded from the database, which its snapshot may not contain."""
+
+    def __init__(self):
+        self.terms = Counter()
+        self.stale = False
+
+
+def get_tagger(task_id):
+    task_id = int(task_id)
+    with taggers_lock:
+        tagger = taggers.get(task_id)
+        if tagger is not None:
+            return tagger
+        load = TaggerLoad()
+        loads.setdefault(task_id, []).append(load)
+    try:
+        tagger = load_tagger(task_id)
+    finally:
+        with taggers_lock:
+            loads[task_id].remove(load)
+            if not loads[task_id]:
+                del loads[task_id]
+    with taggers_lock:
+        if load.stale:
+            # annotations were removed meanwhile, the next prediction loads the tagger again
+            return tagger
+        # terms saved before the snapshot was read are counted twice, which only weighs their types
+        for (term, type_id), term_count in load.terms.iteritems():
+            tagger.add(term, type_id, term_count)
+        return taggers.setdefault(task_id, tagger)
+
+
+def is_enabled():
+    # taggers are only loaded by the dictionary entity engine
+    return prediction_settings.get('entity_engine') == ENGINE_DICTIONARY
+
+
+def load_tagger(task_id):
+    cursor = get_connection().cursor()
+    cursor.execute('SELECT UD.DOCUMENT_ID, O."START", O."END", E.TYPE_ID '
+                   'FROM LTN_DEVELOP.ENTITIES E '
+                   'JOIN LTN_DEVELOP.OFFSETS O ON O.ENTITY_ID = E.ID AND O.USER_DOC_ID = E.USER_DOC_ID '
+                   'JOIN LTN_DEVELOP.USER_DOCUMENTS UD ON UD.ID = E.USER_DOC_ID '
+                   'JOIN LTN_DEVELOP.DOCUMENTS D ON D.ID = UD.DOCUMENT_ID '
+                   'JOIN LTN_DEVELOP.TASK_TYPES TT ON TT.ID = E.TYPE_ID AND TT.TASK_ID = D.TASK AND TT.RELATION = 0 '
+                   "WHERE D.TASK = ? AND UD.USER_ID NOT LIKE ? ESCAPE '!'", (task_id, '%!_!_predictor'))
+    rows = cursor.fetchall()
+    texts = fetch_texts_and_tasks(cursor, list(set(row[0] for row in rows)))
+    cursor.close()
+    terms = Counter()
+    for document_id, start, end, type_id in rows:
+        text = texts.get(document_id, (None, None))[0]
+        if text is not None:
+            terms[(text[start:end], type_id)] += 1
+    tagger = DictionaryTagger()
+    for (term, type_id), count in terms.iteritems():
+        tagger.add(term, type_id, count)
+    return tagger
+
+
+def record_annotations(task_id, document_id, user_id, added, removed, text=None):
+    """
+    Keeps the tagger of the task up to date with the annotations saved to a document. added and removed count
+    the (start, end, type id) spans that were annotated or are no longer annotated in the document.
+    """
+    if str(user_id).endswith('__predictor') or not (added or removed):
+        return
+    try:
+        task_id = int(task_id)
+    except (TypeError, ValueError):
+        return
+    with taggers_lock:
+        if task_id not in taggers and task_id not in loads:
+            return
+    if text is None:
+        cursor = get_connection().cursor()
+        text = fetch_texts_and_tasks(cursor, [document_id]).get(document_id, (None, None))[0]
+        cursor.close()
+        if text is None:
+            return
+    record_terms(task_id, get_terms(text, added), get_terms(text, removed))
+
+
+def get_terms(text, spans):
+    terms = Counter()
+    for (start, end, type_id), span_count in spans.iteritems():
+        if type_id is not None:
+            terms[(text[int(start):int(end)], int(type_id))] += span_count
+    return terms
+
+
+def record_terms(task_id, added, removed):
+    with taggers_lock:
+        for load in loads.get(task_id, []):
+            load.terms.update(added)
+            if removed:
+                # the snapshot may or may not contain the removed terms, the next prediction loads the tagger again
+                load.stale = True
+        tagger = taggers.get(task_id)
+        if tagger is None:
+            return
+        for (term, type_id), term_count in removed.iteritems():
+            tagger.remove(term, type_id, term_count)
+        for (term, type_id), term_count in added.iteritems():
+            tagger.add(term, type_id, term_count)
+
+
+@app.route('/stats/taggers')
+def get_tagger_stats():
+    with taggers_lock:
+        return respond_with(dict((task_id, {'terms': tagger.size()}) for task_id, tagger in taggers.iteritems()))
@@ -1,8 +1,12 @@
 import random
 
+import pyhdb
+
 from flask import request
 from flask_login import current_user
-from ltnserver import app, respond_with, get_connection
+from ltnserver import app, respond_with, get_connection, execute_prepared
+from ltnserver.documents import document_texts
+from ltnserver.types import invalidate_type_catalogue, document_tasks
 
 
 @app.route('/tasks')
@@ -57,24 +61,25 @@ def manage_task(task_id):
         if params.get('NEW_AUTHOR', None) is None:
             params['NEW_AUTHOR'] = current_user.get_id()
 
-        psid = cursor.prepare(sql_to_prepare)
-        ps = cursor.get_prepared_statement(psid)
         try:
-            cursor.execute_prepared(ps, [params])
-            get_connection().commit()
-        except:
+            execute_prepared(cursor, sql_to_prepare, params)
+        except pyhdb.Warning:
             pass  # Rows affected warning
+        get_connection().commit()
+        if req.get('task_id') is not None:
+            invalidate_type_catalogue(req.get('task_id'))
         return 'OK', 200
     elif request.method == 'DELETE':
         sql_to_prepare = 'CALL LTN_DEVELOP.delete_task (?)'
         params = {'TASK_ID': task_id}
-        psid = cursor.prepare(sql_to_prepare)
-        ps = cursor.get_prepared_statement(psid)
         try:
-            cursor.execute_prepared(ps, [params])
-            get_connection().commit()
-        except:
+            execute_prepared(cursor, sql_to_prepare, params)
+        except pyhdb.Warning:
             pass  # Rows affected warning
+        get_connection().commit()
+        invalidate_type_catalogue(task_id)
+        document_tasks.clear()
+        document_texts.clear()
         return 'OK', 200
 
 
@@ -2,7 +2,7 @@ import time
 
 from threading import Thread
 
-from ltnserver import get_connection
+from ltnserver import get_connection, pooled_connection, execute_prepared
 
 
 should_continue = True
@@ -28,18 +28,49 @@ def call_start_training():
             time.sleep(10)
             continue
 
-        cursor = get_connection().cursor()
-        sql_to_prepare = 'CALL LTN_DEVELOP.LTN_TRAIN (?)'
-        params = {
-            'TASK_ID': task_id
-        }
-        psid = cursor.prepare(sql_to_prepare)
-        ps = cursor.get_prepared_statement(psid)
+        with pooled_connection() as connection:
+            cursor = connection.cursor()
+            sql_to_prepare = 'CALL LTN_DEVELOP.LTN_TRAIN (?)'
+            params = {
+                'TASK_ID': task_id
+            }
 
-        try:
-            cursor.execute_prepared(ps, [params])
-            get_connection().commit()
-        except Exception, e:
-            print 'Error: ', e
-        finally:
-            cursor.close()
+            try:
+                execute_prepared(cursor, sql_to_prepare, params)
+                bump_model_version(cursor, task_id)
+                connection.commit()
+            except Exception, e:
+                print 'Error: ', e
+            finally:
+                cursor.close()
+
+
+def get_model_version(task_id):
+    """
+    Number of training runs of the task, stored as training may run in another process than the server.
+    Returns None if it is unknown, e.g. because the MODEL_VERSIONS table has not been created.
+    """
+    cursor = get_connection().cursor()
+    try:
+        cursor.execute('SELECT VERSION FROM LTN_DEVELOP.MODEL_VERSIONS WHERE TASK_ID = ?', (task_id,))
+        row = cursor.fetchone()
+    except Exception, e:
+        print 'Could not read the model version: ', e
+        return None
+    finally:
+        cursor.close()
+    return row[0] if row else 0
+
+
+def bump_model_version(cursor, task_id):
+    # committed together with the trained model, so predictions of older models are not reused
+    try:
+        cursor.execute('SELECT VERSION FROM LTN_DEVELOP.MODEL_VERSIONS WHERE TASK_ID = ?', (task_id,))
+        if cursor.fetchone() is None:
+            cursor.execute('INSERT INTO LTN_DEVELOP.MODEL_VERSIONS VALUES (?, 1)', (task_id,))
+        else:
+            cursor.execute('UPDATE LTN_DEVELOP.MODEL_VERSIONS SET VERSION = VERSION + 1 WHERE TASK_ID = ?',
+                           (task_id,))
+    except Exception, e:
+        # without the table predictions are never reused, the trained model is still saved
+        print 'Could not update the model version: ', e
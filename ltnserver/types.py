@@ -1,20 +1,93 @@
+import hashlib
+
 from flask import request
-from ltnserver import app, respond_with, get_connection
+from ltnserver import app, respond_with, get_connection, transaction
+from ltnserver.cache import LRUCache
+
+type_catalogues = LRUCache('type_catalogues', 1000, size_of=lambda catalogue: 1)
+document_tasks = LRUCache('document_tasks', 100000, size_of=lambda task_id: 1)
+catalogue_generation = 0
+
+
+class TypeCatalogue:
+    """Entity and relation types of a task, indexed by code and by task type id."""
+
+    def __init__(self, task_id, rows):
+        self.task_id = task_id
+        self.version = hashlib.md5(repr(rows)).hexdigest()
+        self.entity_types = []
+        self.relation_types = []
+        self.by_code = {False: {}, True: {}}
+        self.by_id = {}
+        for row in rows:
+            relation = bool(row[7])
+            task_type = {"code": row[0], "name": row[1], "groupId": row[2], "group": row[3],
+                         "label": row[4], "type_id": row[5], "id": row[6]}
+            self.types(relation).append(task_type)
+            self.by_code[relation][task_type['code']] = task_type
+            self.by_id[task_type['id']] = task_type
+
+    def types(self, relation):
+        if relation:
+            return self.relation_types
+        return self.entity_types
+
+
+def get_type_catalogue(task_id):
+    key = str(task_id)
+    catalogue = type_catalogues.get(key)
+    if catalogue is None:
+        generation = catalogue_generation
+        cursor = get_connection().cursor()
+        cursor.execute('SELECT CODE, NAME, GROUP_ID, "GROUP", "LABEL", t.ID, tt.ID, tt.RELATION '
+                       'FROM LTN_DEVELOP.TYPES t '
+                       'JOIN LTN_DEVELOP.TASK_TYPES tt ON t.ID = tt.TYPE_ID '
+                       'WHERE tt.TASK_ID = ? '
+                       'ORDER BY "GROUP" DESC', (task_id,))
+        catalogue = TypeCatalogue(key, cursor.fetchall())
+        cursor.close()
+        # do not cache what was loaded while the types changed
+        if generation == catalogue_generation:
+            type_catalogues.put(key, catalogue)
+    return catalogue
+
+
+def invalidate_type_catalogue(task_id=None):
+    global catalogue_generation
+    catalogue_generation += 1
+    if task_id is None:
+        type_catalogues.clear()
+    else:
+        type_catalogues.invalidate(str(task_id))
+
+
+def get_document_task(document_id):
+    task_id = document_tasks.get(document_id)
+    if task_id is None:
+        cursor = get_connection().cursor()
+        cursor.execute('SELECT TASK FROM LTN_DEVELOP.DOCUMENTS WHERE ID = ?', (document_id,))
+        row = cursor.fetchone()
+        cursor.close()
+        if row is None:
+            return None
+        task_id = row[0]
+        document_tasks.put(document_id, task_id)
+    return task_id
 
 
 def get_types(document_id, relation):
-    cursor = get_connection().cursor()
-    relation_flag = int(relation)
-    cursor.execute('''SELECT CODE, NAME, GROUP_ID, "GROUP", "LABEL", t.ID, tt.ID
-                      FROM LTN_DEVELOP.TYPES t
-                      JOIN LTN_DEVELOP.TASK_TYPES tt ON t.ID = tt.TYPE_ID
-                      JOIN LTN_DEVELOP.DOCUMENTS d ON tt.TASK_ID = d.TASK
-                      WHERE d.id = ? AND tt.RELATION = ?
-                      ORDER BY "GROUP" DESC''', (document_id, relation_flag))
+    task_id = get_document_task(document_id)
+    if task_id is None:
+        return []
+    return get_types_of_task(task_id, relation)
+
+
+def get_types_of_task(task_id, relation):
     types = list()
-    for row in cursor.fetchall():
-        types.append({"code": row[0], "name": "%s (%s)" % (row[4], row[1]), "groupId": row[2], "group": row[3],
-                      "label": row[4], "type_id": row[5], "id": row[6]})
+    for task_type in get_type_catalogue(task_id).types(relation):
+        task_type = dict(task_type)
+        task_type['name'] = "%s (%s)" % (task_type['label'], task_type['name'])
+        types.append(task_type)
     return types
 
 
@@ -64,22 +137,26 @@ def manage_task_type(type_id):
         cursor.execute('SELECT ID FROM LTN_DEVELOP.TASK_TYPES WHERE ID = ?', (type_id,))
         already_existing = cursor.fetchone()
         if already_existing:
-            cursor.execute('UPDATE LTN_DEVELOP.TASK_TYPES SET ID = ?, LABEL = ?, TYPE_ID = ? '
-                           'WHERE ID = ?',
-                           (updated_type.get('id'), updated_type.get('label'), updated_type.get('type_id'), type_id))
-            get_connection().commit()
+            with transaction():
+                cursor.execute('UPDATE LTN_DEVELOP.TASK_TYPES SET ID = ?, LABEL = ?, TYPE_ID = ? '
+                               'WHERE ID = ?',
+                               (updated_type.get('id'), updated_type.get('label'), updated_type.get('type_id'),
+                                type_id))
+            invalidate_type_catalogue()
             return 'UPDATED', 200
         else:
             task_id = req.get('task')
             is_relation = req.get('relation')
-            cursor.execute('INSERT INTO LTN_DEVELOP.TASK_TYPES (LABEL, TASK_ID, TYPE_ID, RELATION) '
-                           'VALUES (?, ?, ?, ?)',
-                           (updated_type.get('label'), task_id, updated_type.get('type_id'), is_relation))
-            get_connection().commit()
+            with transaction():
+                cursor.execute('INSERT INTO LTN_DEVELOP.TASK_TYPES (LABEL, TASK_ID, TYPE_ID, RELATION) '
+                               'VALUES (?, ?, ?, ?)',
+                               (updated_type.get('label'), task_id, updated_type.get('type_id'), is_relation))
+            invalidate_type_catalogue(task_id)
             return 'CREATED', 200
     elif request.method == 'DELETE':
-        cursor.execute('DELETE FROM LTN_DEVELOP.TASK_TYPES WHERE ID = ?', (type_id,))
-        get_connection().commit()
+        with transaction():
+            cursor.execute('DELETE FROM LTN_DEVELOP.TASK_TYPES WHERE ID = ?', (type_id,))
+        invalidate_type_catalogue()
         return 'DELETED', 200
 
 
@@ -94,15 +171,4 @@ def get_task_relation_types(task_id):
 
 
 def get_task_types(task_id, relation):
-    cursor = get_connection().cursor()
-    relation_flag = int(relation)
-    cursor.execute('SELECT CODE, NAME, GROUP_ID, "GROUP", "LABEL", t.ID, tt.ID '
-                   'FROM LTN_DEVELOP.TYPES t '
-                   'JOIN LTN_DEVELOP.TASK_TYPES tt ON t.ID = tt.TYPE_ID '
-                   'WHERE tt.TASK_ID = ? AND tt.RELATION = ? '
-                   'ORDER BY "GROUP" DESC', (task_id, relation_flag))
-    types = list()
-    for row in cursor.fetchall():
-        types.append({"code": row[0], "name": row[1], "groupId": row[2], "group": row[3],
-                      "label": row[4], "type_id": row[5], "id": row[6]})
-    return types
+    return map(dict, get_type_catalogue(task_id).types(relation))
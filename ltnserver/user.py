@@ -1,7 +1,7 @@
 from flask import request
 from flask_login import LoginManager, login_user, logout_user, current_user
 
-from ltnserver import app, get_connection, try_reconnecting, reset_connection, respond_with
+from ltnserver import app, get_connection, reset_connection, respond_with
 
 
 class User:
@@ -59,8 +59,6 @@ def load_user(user_id):
 
 @app.route('/login', methods=['POST'])
 def login():
-    if get_connection() is None:
-        try_reconnecting()
     req = request.get_json()
     if req and 'username' in req and 'password' in req:
         try:
@@ -10,6 +10,9 @@ if __name__ == '__main__':
     if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
         init()
     else:
+        if not debug:
+            # without the reloader, this process serves the requests as well
+            init()
         # This ensures that we can join the thread on exit
         # as flask does not wait on exit for its child processes to gracefully quit
         # unfortunately this means that changes to the code that runs in the
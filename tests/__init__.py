@@ -0,0 +1,79 @@
+"""
+Tests against the local SQLite stand-in of the database, configured through LTN_SETTINGS before ltnserver is imported.
+
+Run with: python -m unittest discover -s tests -t .
+"""
+import json
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+PASSWORD = 'test'
+
+directory = tempfile.mkdtemp(prefix='ltn_tests_')
+settings_path = os.path.join(directory, 'settings.json')
+with open(settings_path, 'w') as f:
+    json.dump({'database': {'backend': 'sqlite', 'path': os.path.join(directory, 'ltn.sqlite')},
+               'secrets': {'development_key': 'test'},
+               'prediction': {'entity_engine': 'dictionary'}}, f)
+os.environ['LTN_SETTINGS'] = settings_path
+# ltnserver reads the static folder from the command line
+sys.argv = sys.argv[:1]
+sys.path.insert(0, ROOT)
+
+seeded = {}
+
+
+def seed_database():
+    """Creates the users test0 and test1 and a task shared by the tests, once per test run."""
+    if not seeded:
+        from ltnserver import get_connection, release_connection
+        connection = get_connection()
+        cursor = connection.cursor()
+        for user_id in ['test0', 'test1']:
+            cursor.execute('INSERT INTO LTN_DEVELOP.USERS VALUES (?, ?, ?, ?, NULL)', (user_id, user_id, PASSWORD, ''))
+        connection.commit()
+        cursor.close()
+        release_connection()
+        seeded.update(create_task())
+    return seeded
+
+
+def create_task():
+    """Creates a task with one entity and one relation type."""
+    from ltnserver import get_connection, release_connection
+    connection = get_connection()
+    cursor = connection.cursor()
+    cursor.execute("INSERT INTO LTN_DEVELOP.TASKS (NAME, DOMAIN, CONFIG, AUTHOR) VALUES ('Test', 'TEST', '', 'test0')")
+    task = {'task_id': cursor.cursor.lastrowid}
+    for code, relation in [('DRUG', 0), ('INTERACTS', 1)]:
+        cursor.execute('INSERT INTO LTN_DEVELOP.TYPES (CODE, NAME, GROUP_ID, "GROUP") VALUES (?, ?, ?, ?)',
+                       (code, code.title(), 'G', 'Group'))
+        cursor.execute('INSERT INTO LTN_DEVELOP.TASK_TYPES (LABEL, TASK_ID, TYPE_ID, RELATION) VALUES (?, ?, ?, ?)',
+                       (code.lower(), task['task_id'], cursor.cursor.lastrowid, relation))
+        task['relation_type_id' if relation else 'entity_type_id'] = cursor.cursor.lastrowid
+    connection.commit()
+    cursor.close()
+    release_connection()
+    return task
+
+
+def logged_in_client(user_id='test0'):
+    from ltnserver import app
+    client = app.test_client()
+    response = client.post('/login', data=json.dumps({'username': user_id, 'password': PASSWORD}),
+                           content_type='application/json')
+    assert response.status_code == 200, response.data
+    return client
+
+
+def import_text(client, document_id, text, task_id=None):
+    response = client.post('/import', data=json.dumps({'type': 'plaintext', 'task': task_id or seeded['task_id'],
+                                                       'document_id': document_id, 'text': text}),
+                           content_type='application/json')
+    assert response.status_code in (200, 201), response.data
+
+
+def denotation(entity_id, begin, end, type_id):
+    return {'id': entity_id, 'span': {'begin': begin, 'end': end}, 'obj': {'id': type_id}}
@@ -0,0 +1,162 @@
+import json
+import unittest
+
+# configures the local database before ltnserver is imported
+from tests import seed_database, logged_in_client, import_text, denotation
+from ltnserver import get_connection, release_connection
+from ltnserver.documents import Changes, diff_annotations, diff_relations, get_submitted_annotations, \
+    get_stored_annotations, get_stored_relations, convert_relations, get_id_map, load_user_doc_id, normalize
+
+TEXT = "It's aspirin and ibuprofen"
+
+
+class DocumentTest(unittest.TestCase):
+    document_count = 0
+
+    def setUp(self):
+        self.task = seed_database()
+        self.drug = self.task['entity_type_id']
+        self.interacts = self.task['relation_type_id']
+        self.client = logged_in_client()
+        DocumentTest.document_count += 1
+        self.document_id = 'document%d' % DocumentTest.document_count
+        import_text(self.client, self.document_id, TEXT)
+
+    def tearDown(self):
+        release_connection()
+
+    def save(self, denotations, relations=()):
+        response = self.client.post('/documents/' + self.document_id,
+                                    data=json.dumps({'task_id': self.task['task_id'], 'denotations': denotations,
+                                                     'relations': list(relations)}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200, response.data)
+
+    def patch(self, operations, expected_status=200):
+        response = self.client.open('/documents/' + self.document_id, method='PATCH',
+                                    data=json.dumps({'task_id': self.task['task_id'], 'operations': operations}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, expected_status, response.data)
+
+    def load(self):
+        response = self.client.get('/documents/' + self.document_id)
+        self.assertEqual(response.status_code, 200, response.data)
+        return json.loads(response.data)
+
+    def stored(self):
+        """Returns the stored {entity id: (type id, [(start, end)])} and [(e1, e2, type id)] of the test user."""
+        cursor = get_connection().cursor()
+        entities, offsets = get_stored_annotations(cursor, load_user_doc_id(self.document_id, 'test0'))
+        pairs = get_stored_relations(cursor, load_user_doc_id(self.document_id, 'test0'))
+        cursor.close()
+        release_connection()
+        return (dict((entity_id, (entity[2], sorted(offset[:2] for offset in offsets[entity_id])))
+                     for entity_id, entity in entities.iteritems()),
+                sorted((pair[1], pair[2], pair[4]) for pair in pairs))
+
+    def diff(self, data):
+        """The changes saving data would make."""
+        user_doc_id = load_user_doc_id(self.document_id, 'test0')
+        cursor = get_connection().cursor()
+        entities, offsets = get_submitted_annotations(user_doc_id, data['denotations'])
+        stored_entities, stored_offsets = get_stored_annotations(cursor, user_doc_id)
+        changes = Changes()
+        diff_annotations(changes, stored_entities, stored_offsets, entities, offsets)
+        diff_relations(changes, get_stored_relations(cursor, user_doc_id),
+                       convert_relations(user_doc_id, data['relations'], get_id_map(data['denotations'])))
+        cursor.close()
+        release_connection()
+        return changes
+
+
+class SaveDocumentTest(DocumentTest):
+
+    def test_saved_document_is_loaded(self):
+        self.save([denotation('a', 5, 12, self.drug), denotation('b', 17, 26, self.drug)],
+                  [{'id': 'r', 'subj': 'a', 'obj': 'b', 'pred': {'id': self.interacts}}])
+        self.assertEqual(self.stored(), ({'a': (self.drug, [(5, 12)]), 'b': (self.drug, [(17, 26)])},
+                                         [('a', 'b', self.interacts)]))
+
+    def test_unchanged_round_trip_changes_nothing(self):
+        self.save([denotation('a', 5, 12, self.drug), denotation('b', 17, 26, self.drug)],
+                  [{'id': 'r', 'subj': 'a', 'obj': 'b', 'pred': {'id': self.interacts}}])
+        changes = self.diff(self.load())
+        self.assertEqual(vars(changes), vars(Changes()))
+
+    def test_changes_are_diffed(self):
+        self.save([denotation('a', 5, 12, self.drug), denotation('b', 17, 26, self.drug)],
+                  [{'id': 'r', 'subj': 'a', 'obj': 'b', 'pred': {'id': self.interacts}}])
+        changes = self.diff({'denotations': [denotation('a', 5, 11, self.drug), denotation('c', 0, 4, self.drug)],
+                             'relations': []})
+        self.assertEqual(changes.deleted_entities, ['b'])
+        self.assertEqual(sorted(changes.deleted_offsets), ['a', 'b'])
+        self.assertEqual([entity[0] for entity in changes.inserted_entities], ['c'])
+        self.assertEqual(sorted(offset[:3] for offset in changes.inserted_offsets), [(0, 4, 'c'), (5, 11, 'a')])
+        self.assertEqual(changes.updated_entities, [])
+        self.assertEqual(len(changes.deleted_pairs), 1)
+
+    def test_removed_entities_lose_their_relations(self):
+        self.save([denotation('a', 5, 12, self.drug), denotation('b', 17, 26, self.drug)],
+                  [{'id': 'r', 'subj': 'a', 'obj': 'b', 'pred': {'id': self.interacts}}])
+        self.save([denotation('a', 5, 12, self.drug)])
+        self.assertEqual(self.stored(), ({'a': (self.drug, [(5, 12)])}, []))
+
+    def test_normalize(self):
+        self.assertEqual(normalize(1), u'1')
+        self.assertIsNone(normalize(None))
+        self.assertIsNone(normalize('None'))
+
+
+class PatchDocumentTest(DocumentTest):
+
+    def test_add_then_remove_stores_nothing(self):
+        self.patch([{'op': 'add', 'denotation': denotation('x', 5, 12, self.drug)},
+                    {'op': 'remove', 'denotation': {'id': 'x'}}])
+        self.assertEqual(self.stored(), ({}, []))
+
+    def test_modifications_apply_in_order(self):
+        self.patch([{'op': 'add', 'denotation': denotation('x', 5, 12, self.drug)},
+                    {'op': 'modify', 'denotation': {'id': 'x', 'span': {'begin': 6, 'end': 12}}}])
+        self.assertEqual(self.stored(), ({'x': (self.drug, [(6, 12)])}, []))
+
+    def test_relation_between_new_entities(self):
+        self.patch([{'op': 'add', 'denotation': denotation('x', 5, 12, self.drug)},
+                    {'op': 'add', 'denotation': denotation('y', 17, 26, self.drug)},
+                    {'op': 'add', 'relation': {'subj': 'x', 'obj': 'y', 'pred': {'id': self.interacts}}}])
+        self.assertEqual(self.stored()[1], [('x', 'y', self.interacts)])
+
+    def test_readded_entity_replaces_the_stored_one(self):
+        self.save([denotation('x', 5, 12, self.drug), denotation('y', 17, 26, self.drug)],
+                  [{'id': 'r', 'subj': 'x', 'obj': 'y', 'pred': {'id': self.interacts}}])
+        self.patch([{'op': 'remove', 'denotation': {'id': 'y'}},
+                    {'op': 'add', 'denotation': denotation('y', 18, 26, self.drug)}])
+        # removing the entity removed its relations as well
+        self.assertEqual(self.stored(), ({'x': (self.drug, [(5, 12)]), 'y': (self.drug, [(18, 26)])}, []))
+
+    def test_invalid_operation_saves_nothing(self):
+        self.patch([{'op': 'add', 'denotation': denotation('x', 5, 12, self.drug)},
+                    {'op': 'frobnicate'}], 400)
+        self.patch([{'op': 'modify', 'denotation': {'id': 'missing', 'span': {'begin': 0, 'end': 2}}}], 400)
+        self.patch('not a list', 400)
+        self.assertEqual(self.stored(), ({}, []))
+
+    def test_relations_of_other_users_cannot_be_removed(self):
+        self.save([denotation('x', 5, 12, self.drug), denotation('y', 17, 26, self.drug)],
+                  [{'id': 'r', 'subj': 'x', 'obj': 'y', 'pred': {'id': self.interacts}}])
+        cursor = get_connection().cursor()
+        cursor.execute('SELECT ID FROM LTN_DEVELOP.PAIRS WHERE USER_DOC_ID = ?',
+                       (load_user_doc_id(self.document_id, 'test0'),))
+        pair_id = cursor.fetchone()[0]
+        cursor.close()
+        release_connection()
+        other = logged_in_client('test1')
+        response = other.open('/documents/' + self.document_id, method='PATCH',
+                              data=json.dumps({'task_id': self.task['task_id'],
+                                               'operations': [{'op': 'remove', 'relation': {'id': pair_id}}]}),
+                              content_type='application/json')
+        self.assertEqual(response.status_code, 400, response.data)
+        self.assertEqual(self.stored()[1], [('x', 'y', self.interacts)])
+
+
+if __name__ == '__main__':
+    unittest.main()
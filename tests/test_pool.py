@@ -0,0 +1,124 @@
+import unittest
+
+# configures the local database before ltnserver is imported
+import tests  # noqa
+from ltnserver.pool import ConnectionPool, PoolTimeout
+
+
+class FakeCursor:
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, statement, parameters=None):
+        pass
+
+    def fetchone(self):
+        return 1,
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+
+    def __init__(self):
+        self.rollbacks = 0
+        self.connected = True
+        self.fail_rollback = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        if self.fail_rollback:
+            raise IOError('connection lost')
+        self.rollbacks += 1
+
+    def close(self):
+        self.connected = False
+
+    def isconnected(self):
+        return self.connected
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.opened = []
+        self.pool = ConnectionPool(self.connect, min_size=1, max_size=2, timeout=0.1)
+
+    def connect(self):
+        self.opened.append(FakeConnection())
+        return self.opened[-1]
+
+    def test_fills_to_min_size(self):
+        self.assertEqual(len(self.opened), 1)
+        self.assertEqual(self.pool.stats()['idle'], 1)
+
+    def test_reuses_returned_connections(self):
+        connection = self.pool.checkout()
+        self.pool.checkin(connection)
+        self.assertIs(self.pool.checkout(), connection)
+        self.assertEqual(len(self.opened), 1)
+
+    def test_checkin_rolls_back_and_resets_the_transaction(self):
+        connection = self.pool.checkout()
+        connection.transaction_depth = 2
+        self.pool.checkin(connection)
+        self.assertEqual(connection.connection.rollbacks, 1)
+        self.assertEqual(connection.transaction_depth, 0)
+
+    def test_connection_failing_to_roll_back_is_discarded(self):
+        connection = self.pool.checkout()
+        connection.connection.fail_rollback = True
+        self.pool.checkin(connection)
+        stats = self.pool.stats()
+        self.assertEqual((stats['size'], stats['idle'], stats['replaced']), (0, 0, 1))
+        self.assertFalse(connection.connection.connected)
+        self.assertIsNot(self.pool.checkout(), connection)
+
+    def test_non_blocking_checkout_of_exhausted_pool(self):
+        self.pool.checkout()
+        self.pool.checkout()
+        self.assertIsNone(self.pool.checkout(blocking=False))
+
+    def test_blocking_checkout_times_out(self):
+        self.pool.checkout()
+        self.pool.checkout()
+        self.assertRaises(PoolTimeout, self.pool.checkout)
+        self.assertEqual(self.pool.stats()['timeouts'], 1)
+
+    def test_waiting_checkout_gets_returned_connection(self):
+        first = self.pool.checkout()
+        self.pool.checkout()
+        self.pool.checkin(first)
+        self.assertIs(self.pool.checkout(), first)
+
+    def test_disconnected_idle_connection_is_replaced(self):
+        connection = self.pool.checkout()
+        self.pool.checkin(connection)
+        connection.connection.connected = False
+        replacement = self.pool.checkout()
+        self.assertIsNot(replacement, connection)
+        self.assertEqual(self.pool.stats()['replaced'], 1)
+        self.assertEqual(self.pool.stats()['size'], 1)
+
+    def test_owner_of_cursor(self):
+        connection = self.pool.checkout()
+        self.assertIs(self.pool.owner(connection.cursor()), connection)
+        self.assertIsNone(self.pool.owner(FakeConnection().cursor()))
+
+    def test_close_discards_idle_connections(self):
+        connection = self.pool.checkout()
+        self.pool.checkin(connection)
+        self.pool.close()
+        self.assertFalse(connection.connection.connected)
+        self.assertIsNone(self.pool.owner(connection.cursor()))
+
+
+if __name__ == '__main__':
+    unittest.main()
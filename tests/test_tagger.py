@@ -0,0 +1,135 @@
+import json
+import unittest
+
+# configures the local database before ltnserver is imported
+from tests import seed_database, create_task, logged_in_client, import_text, denotation
+from ltnserver import app, release_connection
+from ltnserver.tagger import Automaton, DictionaryTagger, get_tagger, taggers
+
+
+class AutomatonTest(unittest.TestCase):
+
+    def find(self, terms, text):
+        automaton = Automaton()
+        for term in terms:
+            automaton.add(term)
+        return sorted(automaton.find(text))
+
+    def test_finds_overlapping_terms(self):
+        self.assertEqual(self.find(['he', 'she', 'his', 'hers'], 'ushers'),
+                         [(1, 4, 'she'), (2, 4, 'he'), (2, 6, 'hers')])
+
+    def test_finds_repeated_terms(self):
+        self.assertEqual(self.find(['aa'], 'aaa'), [(0, 2, 'aa'), (1, 3, 'aa')])
+
+    def test_finds_nothing(self):
+        self.assertEqual(self.find(['aspirin'], 'ibuprofen'), [])
+        self.assertEqual(self.find([], 'ibuprofen'), [])
+
+    def test_terms_added_after_searching(self):
+        automaton = Automaton()
+        automaton.add('abc')
+        self.assertEqual(list(automaton.find('xbcd')), [])
+        automaton.add('bcd')
+        self.assertEqual(list(automaton.find('xbcd')), [(1, 4, 'bcd')])
+
+
+class DictionaryTaggerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tagger = DictionaryTagger()
+
+    def test_tags_longest_match_on_word_boundaries(self):
+        self.tagger.add('acid', 1)
+        self.tagger.add('folic acid', 2)
+        self.tagger.add('lic', 3)
+        self.assertEqual(self.tagger.tag('Folic acid, acidic acid'),
+                         [(0, 10, 'Folic acid', 2), (19, 23, 'acid', 1)])
+
+    def test_uses_the_most_common_type(self):
+        self.tagger.add('aspirin', 1)
+        self.tagger.add('Aspirin', 2, 2)
+        self.assertEqual(self.tagger.tag('aspirin'), [(0, 7, 'aspirin', 2)])
+
+    def test_ignores_short_terms(self):
+        self.tagger.add('an', 1)
+        self.assertEqual(self.tagger.size(), 0)
+
+    def test_removed_terms_are_not_tagged(self):
+        self.tagger.add('aspirin', 1)
+        self.tagger.add('aspirin', 2)
+        self.tagger.remove('aspirin', 2)
+        self.assertEqual(self.tagger.tag('aspirin'), [(0, 7, 'aspirin', 1)])
+        self.tagger.remove('aspirin', 1)
+        self.assertEqual(self.tagger.tag('aspirin'), [])
+        self.assertEqual(self.tagger.size(), 0)
+
+    def test_changes_get_a_new_version(self):
+        version = self.tagger.version
+        self.tagger.add('aspirin', 1)
+        self.assertNotEqual(self.tagger.version, version)
+
+
+class RecordAnnotationsTest(unittest.TestCase):
+    """Saved annotations update the tagger of their task while it is loaded."""
+
+    @classmethod
+    def setUpClass(cls):
+        seed_database()
+        # other tests annotate the shared task
+        cls.task = create_task()
+        cls.drug = cls.task['entity_type_id']
+
+    def setUp(self):
+        self.client = logged_in_client()
+        import_text(self.client, 'tagged', "It's aspirin and ibuprofen", self.task['task_id'])
+        self.save('tagged', [denotation('a', 5, 12, self.drug)])
+        taggers.clear()
+        with app.test_request_context():
+            self.tagger = get_tagger(self.task['task_id'])
+
+    def tearDown(self):
+        for document_id in ['tagged', 'bulk']:
+            self.client.delete('/documents/' + document_id)
+        taggers.clear()
+        release_connection()
+
+    def save(self, document_id, denotations):
+        response = self.client.post('/documents/' + document_id,
+                                    data=json.dumps({'task_id': self.task['task_id'], 'denotations': denotations,
+                                                     'relations': []}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200, response.data)
+
+    def patch(self, document_id, operations):
+        response = self.client.open('/documents/' + document_id, method='PATCH',
+                                    data=json.dumps({'task_id': self.task['task_id'], 'operations': operations}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200, response.data)
+
+    def terms(self):
+        return dict((term, dict(types)) for term, types in self.tagger.types.iteritems())
+
+    def test_loaded_from_the_database(self):
+        self.assertEqual(self.terms(), {'aspirin': {self.drug: 1}})
+
+    def test_saves_add_and_remove_terms(self):
+        self.save('tagged', [denotation('a', 5, 12, self.drug), denotation('b', 17, 26, self.drug)])
+        self.assertEqual(self.terms(), {'aspirin': {self.drug: 1}, 'ibuprofen': {self.drug: 1}})
+        self.save('tagged', [denotation('b', 17, 26, self.drug)])
+        self.assertEqual(self.terms(), {'ibuprofen': {self.drug: 1}})
+        self.assertIs(taggers[self.task['task_id']], self.tagger)
+
+    def test_span_changes_replace_terms(self):
+        self.patch('tagged', [{'op': 'modify', 'denotation': {'id': 'a', 'span': {'begin': 17, 'end': 26}}}])
+        self.assertEqual(self.terms(), {'ibuprofen': {self.drug: 1}})
+
+    def test_bulk_imports_add_terms(self):
+        from ltnserver.formats import import_documents_in_bulk
+        import_documents_in_bulk([{'document_id': 'bulk', 'text': 'more ibuprofen', 'relations': [],
+                                   'denotations': [denotation('i', 5, 14, self.drug)]}], self.task['task_id'], 'test0')
+        self.assertEqual(self.terms(), {'aspirin': {self.drug: 1}, 'ibuprofen': {self.drug: 1}})
+
+
+if __name__ == '__main__':
+    unittest.main()